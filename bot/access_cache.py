@@ -0,0 +1,235 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+
+
+class AccessCache:
+    """
+    In-process cache of access decisions (approved / blocked / paid) keyed by user_id.
+    Only decisions that grant access are cached here, for positive_ttl seconds; denied
+    users are remembered by RejectionShield. The number of cached users is bounded,
+    the least recently used user is evicted first.
+    """
+
+    def __init__(self, max_size: int = 10000, positive_ttl: float = 300.0):
+        """
+        Initializes the cache.
+        :param max_size: maximum number of users kept in the cache
+        :param positive_ttl: lifetime in seconds of decisions that grant access
+        """
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.entries: OrderedDict[int, dict[str, tuple[object, float]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int, key: str):
+        """
+        Returns the cached value for the user and key, or None if it is missing or expired.
+        """
+        user_id = int(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None and key in entry:
+            value, expires_at = entry[key]
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return value
+            del entry[key]
+        self.misses += 1
+        return None
+
+    def set(self, user_id: int, key: str, value):
+        """
+        Stores a decision that grants access to the user.
+        """
+        user_id = int(user_id)
+        entry = self.entries.setdefault(user_id, {})
+        entry[key] = (value, time.monotonic() + self.positive_ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: int):
+        """
+        Drops every cached decision for the user.
+        """
+        self.entries.pop(int(user_id), None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters.
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class TokenBucket:
+    """
+    Token bucket: up to `capacity` actions in a burst, refilled at `rate` tokens per second.
+    """
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RejectionShield:
+    """
+    Bounded negative cache for users who were denied access (unknown, not yet approved or blocked).
+    It is kept apart from AccessCache so that a flood of unknown users cannot evict
+    the entries of approved users. Repeated messages from a denied user are answered
+    from here without touching the database, and replies to them are throttled by a
+    per-user token bucket.
+    """
+
+    def __init__(self, max_size: int = 50000, ttl: float = 30.0,
+                 reply_burst: float = 3, reply_rate: float = 1 / 60):
+        """
+        Initializes the shield.
+        :param max_size: maximum number of denied users remembered
+        :param ttl: lifetime in seconds of a denied access record
+        :param reply_burst: number of replies a denied user gets in a burst
+        :param reply_rate: replies per second a denied user gets after the burst
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.reply_burst = reply_burst
+        self.reply_rate = reply_rate
+        self.entries: OrderedDict[int, dict] = OrderedDict()
+        self.hits = 0
+        self.throttled = 0
+        self.evictions = 0
+
+    def _entry(self, user_id: int) -> dict:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            entry = {'record': None, 'expires_at': 0.0, 'pending': None,
+                     'bucket': TokenBucket(self.reply_burst, self.reply_rate)}
+            self.entries[user_id] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def get(self, user_id: int):
+        """
+        Returns the cached denied access record of the user, or None.
+        """
+        entry = self.entries.get(int(user_id))
+        if entry is None or entry['record'] is None or entry['expires_at'] <= time.monotonic():
+            return None
+        self.hits += 1
+        return entry['record']
+
+    def deny(self, user_id: int, record: dict):
+        """
+        Remembers a denied access record for ttl seconds.
+        """
+        entry = self._entry(int(user_id))
+        entry['record'] = record
+        entry['expires_at'] = time.monotonic() + self.ttl
+
+    def get_pending(self, user_id: int):
+        """
+        Returns whether the user has a pending join request, or None if unknown.
+        """
+        entry = self.entries.get(int(user_id))
+        if entry is None or entry['expires_at'] <= time.monotonic():
+            return None
+        return entry['pending']
+
+    def set_pending(self, user_id: int, pending: bool):
+        entry = self._entry(int(user_id))
+        entry['pending'] = pending
+        entry['expires_at'] = max(entry['expires_at'], time.monotonic() + self.ttl)
+
+    def allow_reply(self, user_id: int) -> bool:
+        """
+        Consumes a reply token of a denied user. False means the update should be dropped silently.
+        """
+        if self._entry(int(user_id))['bucket'].consume():
+            return True
+        self.throttled += 1
+        return False
+
+    def invalidate(self, user_id: int):
+        self.entries.pop(int(user_id), None)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'throttled': self.throttled,
+            'evictions': self.evictions,
+        }
+
+
+class AccessSnapshot:
+    """
+    Last known sets of approved, paid and blocked user IDs.
+    Refreshed periodically and used to answer access checks while the database is unavailable.
+    """
+
+    def __init__(self):
+        self.approved: set[int] = set()
+        self.paid: set[int] = set()
+        self.blocked: set[int] = set()
+        self.refreshed_at = None
+        self.served = 0
+
+    def update(self, approved, paid, blocked):
+        self.approved = {int(uid) for uid in approved}
+        self.paid = {int(uid) for uid in paid}
+        self.blocked = {int(uid) for uid in blocked}
+        self.refreshed_at = time.time()
+
+    def record(self, user_id: int) -> dict:
+        """
+        Builds an access record for the user from the snapshot.
+        """
+        user_id = int(user_id)
+        self.served += 1
+        blocked = user_id in self.blocked
+        return {
+            "user_id": user_id,
+            "approved": user_id in self.approved and not blocked,
+            "blocked": blocked,
+            "paid": user_id in self.paid,
+            "username": None,
+        }
+
+    def stats(self) -> dict:
+        return {
+            'approved': len(self.approved),
+            'paid': len(self.paid),
+            'blocked': len(self.blocked),
+            'age': time.time() - self.refreshed_at if self.refreshed_at else None,
+            'served': self.served,
+        }
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import time
+from datetime import date
+
+from usage_store import get_usage_store
+from usage_tracker import UsageTracker
+
+
+def budget_period_key(budget_period: str, today: date = None) -> str:
+    """
+    Identifies the current budget period: the day, the month or a single all-time period.
+    """
+    today = today or date.today()
+    if budget_period == "daily":
+        return str(today)
+    if budget_period == "monthly":
+        return str(today)[:7]
+    return "all-time"
+
+
+class BudgetLedger:
+    """
+    Remaining budget per user kept up to date in memory, so the budget gate is a dictionary read.
+    Every charge recorded by a UsageTracker is subtracted at once. An entry computed in an
+    earlier budget period, or longer than reconcile_interval seconds ago, is dropped and
+    recomputed by the full calculation (budget lookup and UsageTracker costs) on the next check.
+    Charges of other processes sharing the store are only seen by the full calculation, so an entry
+    is also dropped whenever a tracker is reloaded from the store.
+    """
+
+    def __init__(self, budget_period: str = "monthly", reconcile_interval: float = 60.0):
+        """
+        Initializes the ledger and subscribes it to the charges of all usage trackers.
+        :param budget_period: "daily", "monthly" or "all-time"
+        :param reconcile_interval: seconds after which an entry is recomputed from scratch
+        """
+        self.budget_period = budget_period
+        self.reconcile_interval = reconcile_interval
+        self.entries: dict = {}  # {user_id: [remaining, period_key, computed_at]}
+        self.hits = 0
+        self.misses = 0
+        UsageTracker.charge_listeners.append(self.charge)
+        UsageTracker.reload_listeners.append(self.invalidate)
+
+    def get(self, user_id):
+        """
+        Returns the remaining budget of the user, or None if it has to be computed.
+        """
+        entry = self.entries.get(user_id)
+        if entry is None or entry[1] != budget_period_key(self.budget_period) \
+                or time.monotonic() - entry[2] > self.reconcile_interval:
+            self.entries.pop(user_id, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, remaining: float):
+        """
+        Stores the result of the full calculation.
+        """
+        self.entries[user_id] = [remaining, budget_period_key(self.budget_period), time.monotonic()]
+
+    def charge(self, user_id, cost: float):
+        """
+        Subtracts a recorded charge from the user's remaining budget.
+        """
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            entry[0] -= cost
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+_ledger = None
+
+
+def get_budget_ledger(config: dict) -> BudgetLedger:
+    """
+    Returns the process-wide budget ledger for the configured budget period.
+    With a store shared by several processes (SQLite) entries are trusted no longer
+    than the store's refresh interval, the delay after which other processes' charges are seen.
+    """
+    global _ledger
+    if _ledger is None:
+        reconcile_interval = config.get('budget_reconcile_interval', 60)
+        refresh_interval = getattr(get_usage_store(), 'refresh_interval', 0)
+        if refresh_interval:
+            reconcile_interval = min(reconcile_interval, refresh_interval)
+        _ledger = BudgetLedger(config.get('budget_period', 'monthly'), reconcile_interval)
+    return _ledger
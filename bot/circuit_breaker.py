@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import logging
+import time
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for calls to an external service.
+    After `failure_threshold` consecutive failures the breaker opens and calls are
+    short-circuited for `reset_timeout` seconds. Then a single trial call is let
+    through (half-open): success closes the breaker, failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        Initializes the breaker.
+        :param name: name of the protected service, used in logs
+        :param failure_threshold: consecutive failures that open the breaker
+        :param reset_timeout: seconds to wait before a trial call
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.short_circuited = 0
+        self.trial_in_flight = False
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may be made now.
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.trial_in_flight = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self.times_opened += 1
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str):
+        log = logging.warning if state == self.OPEN else logging.info
+        log(f'Circuit breaker {self.name}: {self.state} -> {state}')
+        self.state = state
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'times_opened': self.times_opened,
+            'short_circuited': self.short_circuited,
+        }
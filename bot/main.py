@@ -6,12 +6,13 @@ import asyncio
 from plugin_manager import PluginManager
 from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
 from telegram_bot import ChatGPTTelegramBot
-from supabase_client import SupabaseClient
+from supabase_client import get_async_supabase_client
+from utils import parse_user_budgets
 
 def main():
     # Load environment variables
     load_dotenv()
-    supabase = SupabaseClient()
+    supabase = get_async_supabase_client()
     print("SupabaseClient импортирован успешно")
 
     # Setup logging
@@ -100,8 +101,22 @@ def main():
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'ru'),
+        'admin_page_size': int(os.environ.get('ADMIN_PAGE_SIZE', 20)),
+        'access_snapshot_interval': float(os.environ.get('ACCESS_SNAPSHOT_INTERVAL', 300)),
+        'trial_flush_interval': float(os.environ.get('TRIAL_FLUSH_INTERVAL', 10)),
+        'trial_cache_ttl': float(os.environ.get('TRIAL_CACHE_TTL', 60)),
+        'trial_cache_size': int(os.environ.get('TRIAL_CACHE_SIZE', 10000)),
+        'usage_cache_size': int(os.environ.get('USAGE_CACHE_SIZE', 10000)),
+        'usage_cache_max_entries': int(os.environ.get('USAGE_CACHE_MAX_ENTRIES', 2000000)),
+        'guest_usage_shards': int(os.environ.get('GUEST_USAGE_SHARDS', 4)),
+        'usage_retention_months': int(os.environ.get('USAGE_RETENTION_MONTHS', 0)),
+        'usage_compaction_interval': float(os.environ.get('USAGE_COMPACTION_INTERVAL', 86400)),
+        'analytics_cache_ttl': float(os.environ.get('ANALYTICS_CACHE_TTL', 600)),
+        'budget_reconcile_interval': float(os.environ.get('BUDGET_RECONCILE_INTERVAL', 60)),
     }
 
+    telegram_config['user_budget_map'] = parse_user_budgets(telegram_config['user_budgets'])
+
     plugin_config = {
         'plugins': os.environ.get('PLUGINS', 'ddg_image_search').split(','),
     }
@@ -2,6 +2,8 @@ from __future__ import annotations
 import datetime
 import logging
 import os
+import threading
+import time
 
 import tiktoken
 
@@ -92,6 +94,54 @@ def localized_text(key, bot_language):
             return key
 
 
+_encodings: dict = {}  # {model: tiktoken.Encoding}
+_encodings_lock = threading.Lock()
+_tokenizer_metrics = {'encodings_loaded': 0, 'messages': 0, 'seconds': 0.0}
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding of the given model, resolved once per process.
+    Unknown models fall back to o200k_base.
+    :param model: The model name
+    :return: The encoding
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+            _tokenizer_metrics['encodings_loaded'] += 1
+        return _encodings[model]
+
+
+def warm_encodings(*models: str):
+    """
+    Loads the encodings of the given models ahead of the first message.
+    """
+    for model in models:
+        if not model:
+            continue
+        try:
+            get_encoding(model)
+        except Exception as e:
+            logging.warning(f'Could not load the tiktoken encoding for model {model}: {e}')
+
+
+def get_tokenizer_stats() -> dict:
+    """
+    Returns the counters of token counting: loaded encodings, messages tokenised and time spent.
+    """
+    with _encodings_lock:
+        stats = dict(_tokenizer_metrics)
+    stats['avg_message_ms'] = stats['seconds'] / stats['messages'] * 1000 if stats['messages'] else 0.0
+    return stats
+
+
 class OpenAIHelper:
     """
     ChatGPT helper class.
@@ -110,6 +160,9 @@ class OpenAIHelper:
         self.conversations: dict[int: list] = {}  # {chat_id: history}
         self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
         self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.conversation_tokens: dict[int: list] = {}  # {chat_id: tokens of each message in history}
+        self.conversation_token_totals: dict[int: int] = {}  # {chat_id: sum of conversation_tokens}
+        warm_encodings(config['model'], config.get('vision_model'))
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -119,7 +172,7 @@ class OpenAIHelper:
         """
         if chat_id not in self.conversations:
             self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        return len(self.conversations[chat_id]), self.__history_tokens(chat_id)
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
@@ -189,7 +242,7 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = str(self.__history_tokens(chat_id))
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -225,7 +278,7 @@ class OpenAIHelper:
             self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
+            token_count = self.__history_tokens(chat_id)
             exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
             exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
 
@@ -239,7 +292,7 @@ class OpenAIHelper:
                     self.__add_to_history(chat_id, role="user", content=query)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    self.__truncate_history(chat_id, self.config['max_history_size'])
 
             max_tokens_str = 'max_completion_tokens' if self.config['model'] in O_MODELS else 'max_tokens'
             common_args = {
@@ -416,7 +469,7 @@ class OpenAIHelper:
                 self.__add_to_history(chat_id, role="user", content=query)
 
             # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
+            token_count = self.__history_tokens(chat_id)
             exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
             exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
 
@@ -424,15 +477,15 @@ class OpenAIHelper:
                 logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
                 try:
                     
-                    last = self.conversations[chat_id][-1]
+                    last, last_tokens = self.conversations[chat_id][-1], self.conversation_tokens[chat_id][-1]
                     summary = await self.__summarise(self.conversations[chat_id][:-1])
                     logging.debug(f'Summary: {summary}')
                     self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
                     self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
+                    self.__append_to_history(chat_id, last, last_tokens)
                 except Exception as e:
                     logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+                    self.__truncate_history(chat_id, self.config['max_history_size'])
 
             message = {'role':'user', 'content':content}
 
@@ -549,7 +602,7 @@ class OpenAIHelper:
                 yield answer, 'not_finished'
         answer = answer.strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        tokens_used = str(self.__history_tokens(chat_id))
 
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -565,9 +618,10 @@ class OpenAIHelper:
     def reset_chat_history(self, chat_id, content=''):
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [
-            { "role": "system", "content": content }
-        ]
+        self.conversations[chat_id] = []
+        self.conversation_tokens[chat_id] = []
+        self.conversation_token_totals[chat_id] = 0
+        self.__append_to_history(chat_id, { "role": "system", "content": content })
         self.conversations_vision[chat_id] = False
 
 
@@ -588,7 +642,7 @@ class OpenAIHelper:
         """
         Adds a function call to the conversation history
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        self.__append_to_history(chat_id, {"role": "function", "name": function_name, "content": content})
 
     def __add_to_history(self, chat_id, role, content):
         """
@@ -597,7 +651,35 @@ class OpenAIHelper:
         :param role: The role of the message sender
         :param content: The message content
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        self.__append_to_history(chat_id, {"role": role, "content": content})
+
+    def __append_to_history(self, chat_id, message, tokens=None):
+        """
+        Appends a message to the conversation history together with its token count,
+        kept in conversation_tokens because the messages themselves are sent to the API as they are.
+        :param chat_id: The chat ID
+        :param message: The message
+        :param tokens: The token count of the message, counted if not given
+        """
+        if tokens is None:
+            tokens = self.__count_message_tokens(message)
+        self.conversations[chat_id].append(message)
+        self.conversation_tokens[chat_id].append(tokens)
+        self.conversation_token_totals[chat_id] += tokens
+
+    def __truncate_history(self, chat_id, max_size):
+        """
+        Keeps only the last max_size messages of the conversation history.
+        """
+        self.conversations[chat_id] = self.conversations[chat_id][-max_size:]
+        self.conversation_tokens[chat_id] = self.conversation_tokens[chat_id][-max_size:]
+        self.conversation_token_totals[chat_id] = sum(self.conversation_tokens[chat_id])
+
+    def __history_tokens(self, chat_id) -> int:
+        """
+        Number of tokens required to send the conversation history, from the running total.
+        """
+        return self.conversation_token_totals[chat_id] + 3  # every reply is primed with <|start|>assistant<|message|>
 
     async def __summarise(self, conversation) -> str:
         """
@@ -645,42 +727,40 @@ class OpenAIHelper:
         )
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __count_message_tokens(self, message) -> int:
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
+        Counts the number of tokens of a single message, without the reply priming.
+        :param message: the message
         :return: the number of tokens required
         """
+        started = time.perf_counter()
         model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("o200k_base")
+        encoding = get_encoding(model)
 
         if model in GPT_ALL_MODELS:
             tokens_per_message = 3
             tokens_per_name = 1
         else:
             raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            if key == 'content':
+                if isinstance(value, str):
                     num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                else:
+                    for message1 in value:
+                        if message1['type'] == 'image_url':
+                            image = decode_image(message1['image_url']['url'])
+                            num_tokens += self.__count_tokens_vision(image)
+                        else:
+                            num_tokens += len(encoding.encode(message1['text']))
+            else:
+                num_tokens += len(encoding.encode(value))
+                if key == "name":
+                    num_tokens += tokens_per_name
+        with _encodings_lock:
+            _tokenizer_metrics['messages'] += 1
+            _tokenizer_metrics['seconds'] += time.perf_counter() - started
         return num_tokens
 
     # no longer needed
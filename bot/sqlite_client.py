@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+create table if not exists users (
+    id       text primary key,
+    username text,
+    status   text,
+    paid     integer not null default 0
+);
+create table if not exists blocked_users (
+    user_id  integer primary key,
+    username text
+);
+create table if not exists trial_requests (
+    user_id integer primary key,
+    used    integer not null default 0
+);
+create table if not exists join_requests (
+    user_id    integer primary key,
+    username   text,
+    created_at text not null default current_timestamp
+);
+"""
+
+
+class SQLiteClient:
+    """
+    Локальная замена SupabaseClient поверх файла SQLite с теми же таблицами
+    (users, blocked_users, join_requests) и тем же набором публичных методов,
+    кроме table(): построитель запросов PostgREST боту больше не нужен.
+    Включается переменной DB_BACKEND=sqlite, путь к файлу — SQLITE_PATH.
+    Нужна для нагрузочных тестов и запуска бота без Supabase.
+    """
+
+    def __init__(self, path: str = "data/bot.db"):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def _query(self, sql: str, params: tuple = ()) -> list[dict]:
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def _execute(self, *statements: tuple):
+        """
+        Выполняет несколько (sql, params) в одной транзакции.
+        """
+        with self.lock, self.conn:
+            for sql, params in statements:
+                self.conn.execute(sql, params)
+
+    def is_user_approved(self, user_id: int) -> bool:
+        return self.get_access_record(user_id)["approved"]
+
+    def is_approved(self, user_id: int) -> bool:
+        return self.is_user_approved(user_id)
+
+    def is_blocked(self, user_id: int) -> bool:
+        return bool(self._query("select 1 from blocked_users where user_id = ?", (int(user_id),)))
+
+    def get_pending_requests(self) -> list[dict]:
+        return self._query("select user_id, username, created_at from join_requests")
+
+    def get_request(self, user_id: int) -> dict:
+        rows = self._query("select user_id, username from join_requests where user_id = ?", (int(user_id),))
+        return rows[0] if rows else None
+
+    def has_pending_request(self, user_id: int) -> bool:
+        return self.get_request(user_id) is not None
+
+    def get_requests(self) -> dict[str, dict]:
+        return {str(req.get("user_id")): req for req in self.get_pending_requests()}
+
+    def get_users(self) -> dict[str, dict]:
+        rows = self._query("select id, username, status, paid = 1 as paid from users")
+        return {str(rec.get("id")): {**rec, "paid": bool(rec["paid"])} for rec in rows}
+
+    def get_blocked_users(self) -> list[dict]:
+        return self._query("select user_id, username from blocked_users")
+
+    def _page(self, table_name: str, columns: str, key: str, after=None, before=None,
+              limit: int = 20, filters: dict = None) -> tuple[list[dict], bool]:
+        conditions, params = [], []
+        for column, value in (filters or {}).items():
+            conditions.append(f"{column} = ?")
+            params.append(value)
+        if before is not None:
+            conditions.append(f"{key} < ?")
+            params.append(before)
+            order = "desc"
+        else:
+            if after is not None:
+                conditions.append(f"{key} > ?")
+                params.append(after)
+            order = "asc"
+        where = f"where {' and '.join(conditions)}" if conditions else ""
+        rows = self._query(
+            f"select {columns} from {table_name} {where} order by {key} {order} limit ?",
+            (*params, limit + 1)
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+
+    def get_users_page(self, after: str = None, before: str = None, limit: int = 20,
+                       status: str = None) -> tuple[list[dict], bool]:
+        filters = {"status": status} if status else None
+        return self._page("users", "id, username, status", "id", after, before, limit, filters)
+
+    def get_requests_page(self, after: int = None, before: int = None, limit: int = 20) -> tuple[list[dict], bool]:
+        return self._page("join_requests", "user_id, username", "user_id", after, before, limit)
+
+    def get_blocked_users_page(self, after: int = None, before: int = None,
+                               limit: int = 20) -> tuple[list[dict], bool]:
+        return self._page("blocked_users", "user_id, username", "user_id", after, before, limit)
+
+    def add_join_request(self, user_id: int, username: str):
+        try:
+            self._execute(("insert into join_requests (user_id, username) values (?, ?)", (int(user_id), username)))
+        except Exception as e:
+            print(f"[ERROR] add_join_request: {e}")
+
+    def approve_user(self, user_id: int, username: str):
+        try:
+            self._execute(
+                ("delete from blocked_users where user_id = ?", (int(user_id),)),
+                ("insert into users (id, username, status) values (?, ?, 'approved') "
+                 "on conflict (id) do update set username = excluded.username, status = 'approved'",
+                 (str(user_id), username)),
+                ("delete from join_requests where user_id = ?", (int(user_id),)),
+            )
+        except Exception as e:
+            print(f"[ERROR] approve_user: {e}")
+
+    def approve_all_pending(self) -> list[dict]:
+        try:
+            with self.lock, self.conn:
+                pending = [dict(row) for row in self.conn.execute(
+                    "select user_id, username from join_requests order by user_id").fetchall()]
+                self.conn.execute("delete from blocked_users where user_id in (select user_id from join_requests)")
+                self.conn.execute(
+                    "insert into users (id, username, status) "
+                    "select cast(user_id as text), username, 'approved' from join_requests where true "
+                    "on conflict (id) do update set username = excluded.username, status = 'approved'"
+                )
+                self.conn.execute("delete from join_requests")
+            return pending
+        except Exception as e:
+            print(f"[ERROR] approve_all_pending: {e}")
+            return []
+
+    def reject_user(self, user_id: int):
+        try:
+            self._execute(
+                ("insert or ignore into blocked_users (user_id, username) "
+                 "values (?, (select username from join_requests where user_id = ?))",
+                 (int(user_id), int(user_id))),
+                ("delete from join_requests where user_id = ?", (int(user_id),)),
+            )
+        except Exception as e:
+            print(f"[ERROR] reject_user: {e}")
+
+    def block_user(self, user_id: int):
+        try:
+            self._execute(
+                ("insert into blocked_users (user_id, username) "
+                 "values (?, (select username from users where id = ?)) "
+                 "on conflict (user_id) do update set username = excluded.username",
+                 (int(user_id), str(user_id))),
+                ("delete from users where id = ?", (str(user_id),)),
+            )
+        except Exception as e:
+            print(f"[ERROR] block_user: {e}")
+
+    def unblock_user(self, user_id: int):
+        try:
+            self._execute(("delete from blocked_users where user_id = ?", (int(user_id),)))
+        except Exception as e:
+            print(f"[ERROR] unblock_user: {e}")
+
+    def is_user_paid(self, user_id: int) -> bool:
+        return self.get_access_record(user_id)["paid"]
+
+    def fetch_access_snapshot(self, page_size: int = 500) -> dict[str, list]:
+        users = self._query("select id, status, paid from users")
+        blocked = self._query("select user_id from blocked_users")
+        return {
+            "approved": [row["id"] for row in users if row["status"] == "approved"],
+            "paid": [row["id"] for row in users if row["paid"]],
+            "blocked": [row["user_id"] for row in blocked],
+        }
+
+    def fetch_access_record(self, user_id: int) -> dict:
+        return self.get_access_record(user_id)
+
+    def get_access_record(self, user_id: int) -> dict:
+        rows = self._query(
+            "select coalesce(u.status = 'approved', 0) and not b.flag as approved, b.flag as blocked, "
+            "coalesce(u.paid, 0) as paid, u.username "
+            "from (select exists(select 1 from blocked_users where user_id = ?) as flag) as b "
+            "left join users u on u.id = ?",
+            (int(user_id), str(user_id))
+        )
+        row = rows[0]
+        return {
+            "user_id": user_id,
+            "approved": bool(row["approved"]),
+            "blocked": bool(row["blocked"]),
+            "paid": bool(row["paid"]),
+            "username": row["username"],
+        }
+
+    def get_trial_requests(self, user_id: int) -> int:
+        rows = self._query("select used from trial_requests where user_id = ?", (int(user_id),))
+        return int(rows[0]["used"]) if rows else 0
+
+    def increment_trial_requests(self, deltas: dict[int, int]):
+        self._execute(*[
+            ("insert into trial_requests (user_id, used) values (?, ?) "
+             "on conflict (user_id) do update set used = used + excluded.used", (int(uid), delta))
+            for uid, delta in deltas.items()
+        ])
+
+    def mark_user_paid(self, user_id: int):
+        try:
+            self._execute(("update users set paid = 1 where id = ?", (str(user_id),)))
+        except Exception as e:
+            print(f"[ERROR] mark_user_paid: {e}")
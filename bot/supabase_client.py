@@ -1,11 +1,24 @@
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
 import os
+import threading
+import time
+
+import httpx
+
+from access_cache import AccessCache, RejectionShield, AccessSnapshot
+from circuit_breaker import CircuitBreaker
 
 class SupabaseClient:
-    def __init__(self):
+    def __init__(self, http_client: httpx.Client = None):
         url = os.getenv("SUPABASE_URL")
         key = os.getenv("SUPABASE_KEY")
-        self.client = create_client(url, key)
+        if http_client is not None:
+            self.client = create_client(url, key, options=ClientOptions(httpx_client=http_client))
+        else:
+            self.client = create_client(url, key)
         def table(self, table_name: str):
             return self.client.table(table_name)
 
@@ -45,6 +58,21 @@ class SupabaseClient:
             print(f"[ERROR] get_pending_requests: {e}")
             return []
 
+    def get_request(self, user_id: int) -> dict:
+        """
+        Возвращает заявку пользователя или None (точечный запрос по индексу user_id).
+        """
+        try:
+            response = self.client.table("join_requests").select("user_id, username")\
+                .eq("user_id", user_id).limit(1).execute()
+            return response.data[0] if response.data else None
+        except Exception as e:
+            print(f"[ERROR] get_request: {e}")
+            return None
+
+    def has_pending_request(self, user_id: int) -> bool:
+        return self.get_request(user_id) is not None
+
     def get_requests(self) -> dict[str, dict]:
         """
         Возвращает все pending-заявки в формате {user_id: info_dict}.
@@ -68,6 +96,61 @@ class SupabaseClient:
             print(f"[ERROR] get_users: {e}")
             return {}
 
+    def _page(self, table_name: str, columns: str, key: str, after=None, before=None,
+              limit: int = 20, filters: dict = None) -> tuple[list[dict], bool]:
+        """
+        Keyset-пагинация: строки с key > after (или key < before), отсортированные по key.
+        Возвращает (строки, есть_ли_ещё_в_этом_направлении).
+        """
+        query = self.client.table(table_name).select(columns)
+        for column, value in (filters or {}).items():
+            query = query.eq(column, value)
+        if before is not None:
+            query = query.lt(key, before).order(key, desc=True)
+        else:
+            if after is not None:
+                query = query.gt(key, after)
+            query = query.order(key)
+        rows = query.limit(limit + 1).execute().data or []
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before is not None:
+            rows.reverse()
+        return rows, has_more
+
+    def get_users_page(self, after: str = None, before: str = None, limit: int = 20,
+                       status: str = None) -> tuple[list[dict], bool]:
+        """
+        Страница пользователей (id, username, status), курсор — id.
+        """
+        try:
+            filters = {"status": status} if status else None
+            return self._page("users", "id, username, status", "id", after, before, limit, filters)
+        except Exception as e:
+            print(f"[ERROR] get_users_page: {e}")
+            return [], False
+
+    def get_requests_page(self, after: int = None, before: int = None, limit: int = 20) -> tuple[list[dict], bool]:
+        """
+        Страница заявок (user_id, username), курсор — user_id.
+        """
+        try:
+            return self._page("join_requests", "user_id, username", "user_id", after, before, limit)
+        except Exception as e:
+            print(f"[ERROR] get_requests_page: {e}")
+            return [], False
+
+    def get_blocked_users_page(self, after: int = None, before: int = None,
+                               limit: int = 20) -> tuple[list[dict], bool]:
+        """
+        Страница заблокированных (user_id, username), курсор — user_id.
+        """
+        try:
+            return self._page("blocked_users", "user_id, username", "user_id", after, before, limit)
+        except Exception as e:
+            print(f"[ERROR] get_blocked_users_page: {e}")
+            return [], False
+
     def get_blocked_users(self) -> list[dict]:
         try:
             response = self.client.table("blocked_users").select("user_id, username").execute()
@@ -86,34 +169,30 @@ class SupabaseClient:
             print(f"[ERROR] add_join_request: {e}")
 
     def approve_user(self, user_id: int, username: str):
+        """
+        Одобряет пользователя одной транзакцией на сервере (RPC approve_user,
+        см. migrations/002_transactional_user_actions.sql).
+        """
         try:
-            # 1) Удалить из заблокированных, если там есть
-            self.client.table("blocked_users")\
-                .delete()\
-                .eq("user_id", user_id)\
-                .execute()
-
-            # 2) Добавить в таблицу users
-            self.client.table("users").insert({
-                "id": str(user_id),
-                "username": username,
-                "status": "approved"
-            }).execute()
-
-            # 3) Удалить из join_requests
-            self.client.table("join_requests")\
-                .delete()\
-                .eq("user_id", user_id)\
-                .execute()
+            self.client.rpc("approve_user", {"p_user_id": user_id, "p_username": username}).execute()
         except Exception as e:
             print(f"[ERROR] approve_user: {e}")
 
+    def approve_all_pending(self) -> list[dict]:
+        """
+        Одобряет все заявки одним запросом (RPC approve_all_pending).
+        Возвращает одобренных пользователей [{user_id, username}, ...].
+        """
+        try:
+            resp = self.client.rpc("approve_all_pending", {}).execute()
+            return resp.data or []
+        except Exception as e:
+            print(f"[ERROR] approve_all_pending: {e}")
+            return []
+
     def reject_user(self, user_id: int):
         try:
-            self.client.table("join_requests").delete().eq("user_id", user_id).execute()
-            self.client.table("blocked_users").insert({
-                "user_id": user_id
-            }).execute()
+            self.client.rpc("reject_user", {"p_user_id": user_id}).execute()
         except Exception as e:
             print(f"[ERROR] reject_user: {e}")
 
@@ -125,16 +204,7 @@ class SupabaseClient:
     
     def block_user(self, user_id: int):
         try:
-            # Получаем username перед удалением
-            response = self.client.table("users").select("username").eq("id", str(user_id)).execute()
-            username = response.data[0].get("username", "") if response.data else ""
-
-            self.client.table("blocked_users").upsert({
-                "user_id": user_id,
-                "username": username
-            }).execute()
-
-            self.client.table("users").delete().eq("id", str(user_id)).execute()
+            self.client.rpc("block_user", {"p_user_id": user_id}).execute()
         except Exception as e:
             print(f"[ERROR] block_user: {e}")
 
@@ -162,6 +232,78 @@ class SupabaseClient:
             print(f"[ERROR] is_user_paid: {e}")
             return False
 
+    def fetch_access_record(self, user_id: int) -> dict:
+        """
+        Возвращает статус доступа пользователя одним запросом (RPC get_access_record,
+        см. migrations/001_get_access_record.sql):
+        {"user_id": ..., "approved": bool, "blocked": bool, "paid": bool, "username": str | None}
+        В отличие от get_access_record пробрасывает ошибки — их учитывает circuit breaker.
+        """
+        resp = self.client.rpc("get_access_record", {"p_user_id": user_id}).execute()
+        rows = resp.data or []
+        row = rows[0] if rows else {}
+        return {
+            "user_id": user_id,
+            "approved": bool(row.get("approved")),
+            "blocked": bool(row.get("blocked")),
+            "paid": bool(row.get("paid")),
+            "username": row.get("username"),
+        }
+
+    def get_access_record(self, user_id: int) -> dict:
+        try:
+            return self.fetch_access_record(user_id)
+        except Exception as e:
+            print(f"[ERROR] get_access_record: {e}")
+            return {"user_id": user_id, "approved": False, "blocked": False, "paid": False, "username": None}
+
+    def fetch_access_snapshot(self, page_size: int = 500) -> dict[str, list]:
+        """
+        Загружает постранично id одобренных, оплативших и заблокированных пользователей
+        для AccessSnapshot. Ошибки пробрасываются.
+        Сервер обрезает ответ до max-rows (по умолчанию 1000) независимо от limit, поэтому
+        has_more здесь ненадёжен: листаем до пустой страницы.
+        """
+        approved, paid, blocked = [], [], []
+        after = None
+        while True:
+            rows, _ = self._page("users", "id, status, paid", "id", after=after, limit=page_size)
+            for row in rows:
+                if row.get("status") == "approved":
+                    approved.append(row["id"])
+                if row.get("paid") is True:
+                    paid.append(row["id"])
+            if not rows:
+                break
+            after = rows[-1]["id"]
+        after = None
+        while True:
+            rows, _ = self._page("blocked_users", "user_id", "user_id", after=after, limit=page_size)
+            blocked += [row["user_id"] for row in rows]
+            if not rows:
+                break
+            after = rows[-1]["user_id"]
+        return {"approved": approved, "paid": paid, "blocked": blocked}
+
+    def get_trial_requests(self, user_id: int) -> int:
+        """
+        Сколько пробных запросов пользователь уже использовал (таблица trial_requests).
+        Ошибки пробрасываются, чтобы не обнулить счётчик по сбою сети.
+        """
+        resp = self.client.table("trial_requests").select("used").eq("user_id", user_id).execute()
+        return int(resp.data[0]["used"]) if resp.data else 0
+
+    def increment_trial_requests(self, deltas: dict[int, int]):
+        """
+        Атомарно прибавляет приращения к счётчикам пробных запросов одним вызовом
+        (RPC increment_trial_requests, см. migrations/003_trial_requests.sql).
+        Ошибки пробрасываются, чтобы вызывающий мог повторить сброс.
+        """
+        self.client.rpc(
+            "increment_trial_requests",
+            {"p_deltas": {str(uid): delta for uid, delta in deltas.items()}}
+        ).execute()
+
     def mark_user_paid(self, user_id: int):
         """
         Помечает в базе пользователя как оплатившего подписку.
@@ -174,4 +316,386 @@ class SupabaseClient:
                 .eq("id", str(user_id)) \
                 .execute()
         except Exception as e:
-            print(f"[ERROR] mark_user_paid: {e}")
\ No newline at end of file
+            print(f"[ERROR] mark_user_paid: {e}")
+
+
+class PoolMetrics:
+    """
+    Счётчики HTTP-запросов к Supabase через общий пул соединений.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients_created = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def started(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+
+    def finished(self, elapsed: float, failed: bool):
+        with self.lock:
+            self.in_flight -= 1
+            self.total_time += elapsed
+            if failed:
+                self.errors += 1
+
+
+class MeteredTransport(httpx.HTTPTransport):
+    """
+    HTTP-транспорт с keep-alive пулом, который считает запросы в PoolMetrics.
+    """
+
+    def __init__(self, metrics: PoolMetrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self.metrics.started()
+        started_at = time.monotonic()
+        failed = True
+        try:
+            response = super().handle_request(request)
+            failed = False
+            return response
+        finally:
+            self.metrics.finished(time.monotonic() - started_at, failed)
+
+    def open_connections(self) -> int:
+        pool = getattr(self, "_pool", None)
+        return len(getattr(pool, "connections", []))
+
+
+_registry_lock = threading.Lock()
+_pool_metrics = PoolMetrics()
+_transport = None
+_sync_client = None
+_async_client = None
+_executor = None
+
+
+def pool_size() -> int:
+    return int(os.getenv("SUPABASE_POOL_SIZE", "10"))
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Общий ограниченный пул потоков для всех запросов к Supabase.
+    Размер задаётся переменной окружения SUPABASE_MAX_WORKERS (по умолчанию SUPABASE_POOL_SIZE).
+    """
+    global _executor
+    with _registry_lock:
+        if _executor is None:
+            max_workers = int(os.getenv("SUPABASE_MAX_WORKERS", str(pool_size())))
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+    return _executor
+
+
+def get_supabase_client() -> SupabaseClient:
+    """
+    Общий для процесса SupabaseClient поверх одного httpx.Client с keep-alive пулом.
+    Настройки: SUPABASE_POOL_SIZE, SUPABASE_TIMEOUT, SUPABASE_KEEPALIVE_EXPIRY.
+    При DB_BACKEND=sqlite вместо него возвращается локальный SQLiteClient (файл SQLITE_PATH).
+    """
+    global _sync_client, _transport
+    with _registry_lock:
+        if _sync_client is None and os.getenv("DB_BACKEND", "supabase").lower() == "sqlite":
+            from sqlite_client import SQLiteClient
+            _sync_client = SQLiteClient(os.getenv("SQLITE_PATH", "data/bot.db"))
+            _pool_metrics.clients_created += 1
+        if _sync_client is None:
+            size = pool_size()
+            _transport = MeteredTransport(
+                _pool_metrics,
+                limits=httpx.Limits(
+                    max_connections=size,
+                    max_keepalive_connections=size,
+                    keepalive_expiry=float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30")),
+                ),
+            )
+            http_client = httpx.Client(
+                transport=_transport,
+                timeout=float(os.getenv("SUPABASE_TIMEOUT", "10")),
+            )
+            _sync_client = SupabaseClient(http_client=http_client)
+            _pool_metrics.clients_created += 1
+    return _sync_client
+
+
+def get_async_supabase_client() -> "AsyncSupabaseClient":
+    """
+    Общий для процесса AsyncSupabaseClient поверх get_supabase_client().
+    """
+    global _async_client
+    sync_client = get_supabase_client()
+    with _registry_lock:
+        if _async_client is None:
+            _async_client = AsyncSupabaseClient(sync_client)
+    return _async_client
+
+
+def get_pool_stats() -> dict:
+    """
+    Возвращает метрики пула соединений и пула потоков.
+    """
+    metrics = _pool_metrics
+    with metrics.lock:
+        requests = metrics.requests
+        stats = {
+            'clients_created': metrics.clients_created,
+            'pool_size': pool_size(),
+            'open_connections': _transport.open_connections() if _transport is not None else 0,
+            'requests': requests,
+            'in_flight': metrics.in_flight,
+            'errors': metrics.errors,
+            'avg_latency_ms': metrics.total_time / requests * 1000 if requests else 0.0,
+        }
+    stats['executor_queue'] = _executor._work_queue.qsize() if _executor is not None else 0
+    return stats
+
+
+_access_cache = None
+
+
+def get_access_cache() -> AccessCache:
+    """
+    Общий для процесса кэш решений о доступе.
+    Настраивается переменными ACCESS_CACHE_SIZE и ACCESS_CACHE_POSITIVE_TTL.
+    Отказы здесь не кэшируются — их хранит RejectionShield.
+    """
+    global _access_cache
+    if _access_cache is None:
+        _access_cache = AccessCache(
+            max_size=int(os.getenv("ACCESS_CACHE_SIZE", "10000")),
+            positive_ttl=float(os.getenv("ACCESS_CACHE_POSITIVE_TTL", "300")),
+        )
+    return _access_cache
+
+
+_rejection_shield = None
+
+
+def get_rejection_shield() -> RejectionShield:
+    """
+    Общий для процесса негативный кэш отказов с троттлингом ответов.
+    Настраивается переменными REJECTION_SHIELD_SIZE, ACCESS_CACHE_NEGATIVE_TTL (срок жизни
+    записи об отказе; относится только к этому кэшу, AccessCache отказы не хранит),
+    REJECTION_REPLY_BURST и REJECTION_REPLY_INTERVAL (секунд на один ответ).
+    """
+    global _rejection_shield
+    if _rejection_shield is None:
+        _rejection_shield = RejectionShield(
+            max_size=int(os.getenv("REJECTION_SHIELD_SIZE", "50000")),
+            ttl=float(os.getenv("ACCESS_CACHE_NEGATIVE_TTL", "30")),
+            reply_burst=float(os.getenv("REJECTION_REPLY_BURST", "3")),
+            reply_rate=1 / float(os.getenv("REJECTION_REPLY_INTERVAL", "60")),
+        )
+    return _rejection_shield
+
+
+_access_breaker = None
+
+
+def get_access_breaker() -> CircuitBreaker:
+    """
+    Общий для процесса circuit breaker проверок доступа.
+    Настраивается переменными SUPABASE_BREAKER_THRESHOLD и SUPABASE_BREAKER_RESET.
+    """
+    global _access_breaker
+    if _access_breaker is None:
+        _access_breaker = CircuitBreaker(
+            "supabase",
+            failure_threshold=int(os.getenv("SUPABASE_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("SUPABASE_BREAKER_RESET", "30")),
+        )
+    return _access_breaker
+
+
+class AsyncSupabaseClient:
+    """
+    Асинхронная обёртка над SupabaseClient с тем же набором методов.
+    Синхронные вызовы supabase-py выполняются в общем пуле потоков,
+    поэтому обработчики PTB не блокируют event loop.
+    Статусы approved/blocked/paid берутся из одной записи get_access_record,
+    которая кэшируется в AccessCache и сбрасывается при любом изменении
+    статуса пользователя. Отказы хранятся отдельно в RejectionShield, чтобы
+    поток сообщений от неизвестных пользователей не доходил до базы и не
+    вытеснял из кэша одобренных пользователей.
+    Если Supabase недоступен, circuit breaker размыкается и проверки доступа
+    отвечаются из периодически обновляемого AccessSnapshot.
+    """
+
+    def __init__(self, client: SupabaseClient = None, cache: AccessCache = None,
+                 shield: RejectionShield = None):
+        self.sync = client if client is not None else get_supabase_client()
+        self.cache = cache if cache is not None else get_access_cache()
+        self.shield = shield if shield is not None else get_rejection_shield()
+        self.breaker = get_access_breaker()
+        self.snapshot = AccessSnapshot()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args))
+
+    def _invalidate(self, user_id: int):
+        self.cache.invalidate(user_id)
+        self.shield.invalidate(user_id)
+
+    async def get_access_record(self, user_id: int) -> dict:
+        record = self.cache.get(user_id, "record")
+        if record is None:
+            record = self.shield.get(user_id)
+        if record is None:
+            if not self.breaker.allow():
+                return self.snapshot.record(user_id)
+            try:
+                record = await self._run(self.sync.fetch_access_record, user_id)
+            except Exception as e:
+                print(f"[ERROR] get_access_record: {e}")
+                self.breaker.record_failure()
+                return self.snapshot.record(user_id)
+            self.breaker.record_success()
+            if record["approved"]:
+                self.cache.set(user_id, "record", record)
+            else:
+                self.shield.deny(user_id, record)
+        return record
+
+    async def refresh_snapshot(self) -> bool:
+        """
+        Обновляет AccessSnapshot, если breaker разрешает запрос.
+        """
+        if not self.breaker.allow():
+            return False
+        try:
+            data = await self._run(self.sync.fetch_access_snapshot)
+        except Exception as e:
+            print(f"[ERROR] refresh_snapshot: {e}")
+            self.breaker.record_failure()
+            return False
+        self.breaker.record_success()
+        self.snapshot.update(data["approved"], data["paid"], data["blocked"])
+        return True
+
+    async def run_snapshot_refresher(self, interval: float):
+        """
+        Фоновая задача: обновляет снимок доступа каждые interval секунд.
+        """
+        while True:
+            await self.refresh_snapshot()
+            await asyncio.sleep(interval)
+
+    async def has_pending_request(self, user_id: int) -> bool:
+        """
+        Есть ли у пользователя заявка на вступление; ответ запоминается в RejectionShield.
+        """
+        pending = self.shield.get_pending(user_id)
+        if pending is None:
+            pending = await self._run(self.sync.has_pending_request, user_id)
+            self.shield.set_pending(user_id, pending)
+        return pending
+
+    async def get_request(self, user_id: int) -> dict:
+        return await self._run(self.sync.get_request, user_id)
+
+    async def is_user_approved(self, user_id: int) -> bool:
+        return (await self.get_access_record(user_id))["approved"]
+
+    async def is_approved(self, user_id: int) -> bool:
+        return await self.is_user_approved(user_id)
+
+    async def is_blocked(self, user_id: int) -> bool:
+        return (await self.get_access_record(user_id))["blocked"]
+
+    async def get_pending_requests(self) -> list[dict]:
+        return await self._run(self.sync.get_pending_requests)
+
+    async def get_requests(self) -> dict[str, dict]:
+        return await self._run(self.sync.get_requests)
+
+    async def get_users(self) -> dict[str, dict]:
+        return await self._run(self.sync.get_users)
+
+    async def get_blocked_users(self) -> list[dict]:
+        return await self._run(self.sync.get_blocked_users)
+
+    async def get_users_page(self, after: str = None, before: str = None, limit: int = 20,
+                             status: str = None) -> tuple[list[dict], bool]:
+        return await self._run(self.sync.get_users_page, after, before, limit, status)
+
+    async def get_requests_page(self, after: int = None, before: int = None,
+                                limit: int = 20) -> tuple[list[dict], bool]:
+        return await self._run(self.sync.get_requests_page, after, before, limit)
+
+    async def get_blocked_users_page(self, after: int = None, before: int = None,
+                                     limit: int = 20) -> tuple[list[dict], bool]:
+        return await self._run(self.sync.get_blocked_users_page, after, before, limit)
+
+    async def iter_users(self, status: str = None, page_size: int = 500):
+        """
+        Постранично перебирает пользователей, не загружая таблицу целиком.
+        Как и в fetch_access_snapshot, листаем до пустой страницы: has_more
+        ненадёжен, если сервер обрезает ответ по max-rows.
+        """
+        after = None
+        while True:
+            rows, _ = await self.get_users_page(after=after, limit=page_size, status=status)
+            for row in rows:
+                yield row
+            if not rows:
+                return
+            after = rows[-1]["id"]
+
+    async def add_join_request(self, user_id: int, username: str):
+        result = await self._run(self.sync.add_join_request, user_id, username)
+        self.shield.set_pending(user_id, True)
+        return result
+
+    async def approve_user(self, user_id: int, username: str):
+        try:
+            return await self._run(self.sync.approve_user, user_id, username)
+        finally:
+            self._invalidate(user_id)
+
+    async def approve_all_pending(self) -> list[dict]:
+        approved = await self._run(self.sync.approve_all_pending)
+        for row in approved:
+            self._invalidate(row["user_id"])
+        return approved
+
+    async def reject_user(self, user_id: int):
+        try:
+            return await self._run(self.sync.reject_user, user_id)
+        finally:
+            self._invalidate(user_id)
+
+    async def block_user(self, user_id: int):
+        try:
+            return await self._run(self.sync.block_user, user_id)
+        finally:
+            self._invalidate(user_id)
+
+    async def unblock_user(self, user_id: int):
+        try:
+            return await self._run(self.sync.unblock_user, user_id)
+        finally:
+            self._invalidate(user_id)
+
+    async def is_user_paid(self, user_id: int) -> bool:
+        return (await self.get_access_record(user_id))["paid"]
+
+    async def get_trial_requests(self, user_id: int) -> int:
+        return await self._run(self.sync.get_trial_requests, user_id)
+
+    async def increment_trial_requests(self, deltas: dict[int, int]):
+        return await self._run(self.sync.increment_trial_requests, deltas)
+
+    async def mark_user_paid(self, user_id: int):
+        try:
+            return await self._run(self.sync.mark_user_paid, user_id)
+        finally:
+            self._invalidate(user_id)
@@ -6,6 +6,7 @@ import logging
 import os
 import io
 import json
+import time
 import logging
 import requests
 
@@ -30,11 +31,17 @@ from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicato
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
     cleanup_intermediate_files
 
-from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from openai_helper import OpenAIHelper, localized_text, get_tokenizer_stats
+from trial_counter import TrialCounter
+from usage_tracker import UsageTracker, GuestUsageTracker
+from usage_cache import UsageTrackerCache
+from usage_store import flush_usage_stores, get_usage_store
+from usage_compaction import run_usage_compactor
+from usage_analytics import load_columns, unit_prices
+from budget_ledger import get_budget_ledger
 
 from datetime import datetime
-from supabase_client import SupabaseClient
+from supabase_client import AsyncSupabaseClient, get_async_supabase_client, get_pool_stats
 
 
 
@@ -42,11 +49,15 @@ class ChatGPTTelegramBot:
 
     async def check_access(self, update: Update) -> bool:
         user_id = update.effective_user.id
-        # используем готовый метод
-        if not self.supabase.is_user_approved(user_id):
-            await update.effective_message.reply_text(
-                "⛔️ Доступ запрещён. Пожалуйста, подайте заявку и дождитесь одобрения администратора."
-            )
+        # одна запись доступа на апдейт (approved/blocked/paid)
+        record = await self.supabase.get_access_record(user_id)
+        if not record["approved"]:
+            # отказанным пользователям отвечаем не чаще лимита, остальное молча отбрасываем;
+            # ответ об отказе отправляет только эта проверка, обработчики просто выходят
+            if update.effective_message is not None and self.supabase.shield.allow_reply(user_id):
+                await update.effective_message.reply_text(
+                    "⛔️ Доступ запрещён. Пожалуйста, подайте заявку и дождитесь одобрения администратора."
+                )
             return False
         return True
 
@@ -106,23 +117,29 @@ class ChatGPTTelegramBot:
             logging.error(f"❌ Ошибка: {e}")
             await update.message.reply_text("😔 Не удалось загрузить или отправить изображение.")
 
-    def __init__(self, config: dict, openai: OpenAIHelper, supabase):
+    def __init__(self, config: dict, openai: OpenAIHelper, supabase=None):
         """
         Initializes the bot with the given configuration and GPT bot object.
         :param config: A dictionary containing the bot configuration
         :param openai: OpenAIHelper object
+        :param supabase: SupabaseClient or AsyncSupabaseClient, defaults to the shared pooled client
         """
-        self.supabase = SupabaseClient()
         self.config = config
         self.openai = openai
         self.free_request_limit = 5
-        self.request_counts: dict[int, int] = {}
-        self.supabase = supabase
-        self.db = SupabaseClient()
+        if supabase is None:
+            supabase = get_async_supabase_client()
+        self.supabase = supabase if isinstance(supabase, AsyncSupabaseClient) else AsyncSupabaseClient(supabase)
+        self.trial_counter = TrialCounter(self.supabase, cache_ttl=config.get('trial_cache_ttl', 60),
+                                          breaker=self.supabase.breaker,
+                                          max_size=config.get('trial_cache_size', 10000))
         self.user_profiles: dict[int, dict[str, str]] = {}  # { user_id: {'role': 'teacher'|'student', 'lang': 'Английский'}, ... }
         bot_language = self.config['bot_language']
-        self.usage = {}
-        self.usage["guests"] = UsageTracker("guests", "guest users")
+        self.usage = UsageTrackerCache(
+            max_size=config.get('usage_cache_size', 10000),
+            max_entries=config.get('usage_cache_max_entries', 2000000)
+        )
+        self.usage["guests"] = GuestUsageTracker("guest users", shards=config.get('guest_usage_shards', 4))
 
         self.commands = [
             BotCommand(command='help', description=localized_text('help_description', bot_language)),
@@ -146,20 +163,21 @@ class ChatGPTTelegramBot:
                 # команды только для админов (Chat scope)
         self.admin_commands = list(self.commands) + [
             BotCommand('admin', 'Открыть админ-панель'),
-            BotCommand('all',   'Рассылка сообщения всем пользователям')
+            BotCommand('all',   'Рассылка сообщения всем пользователям'),
+            BotCommand('metrics', 'Метрики кэша, подключений и трекеров'),
+            BotCommand('analytics', 'Топ пользователей по расходам и динамика токенов')
         ]
 
         # Остальные переменные
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
         self.last_message = {}
         self.inline_queries_cache = {}
-        self.usage = {}
-        self.usage["guests"] = UsageTracker("guests", "guest users")
 
         self.admin_user_ids = config.get("admin_user_ids", [])
         self.allowed_user_ids = config.get("allowed_user_ids", [])  # Возможно, больше не нужен
+        self.admin_page_size = config.get('admin_page_size', 20)
+        self.usage_columns = None  # (loaded_at, UsageColumns) для /analytics
         self.DATA_DIR = "data"
         os.makedirs(self.DATA_DIR, exist_ok=True)
 
@@ -174,8 +192,11 @@ class ChatGPTTelegramBot:
         user_id = user.id
         user_name = user.username or user.full_name
 
-        # 1) Проверка одобрения администратором
-        if not self.supabase.is_user_approved(user_id):
+        # 1) Проверка одобрения администратором — одна запись доступа на весь апдейт
+        record = await self.supabase.get_access_record(user_id)
+        if not record["approved"]:
+            if not self.supabase.shield.allow_reply(user_id):
+                return False
             if is_inline:
                 await update.inline_query.answer(
                     results=[],
@@ -190,8 +211,16 @@ class ChatGPTTelegramBot:
             return False
 
         # 2) Если пользователь не оплатил — применяем лимит пробных запросов
-        if not self.supabase.is_user_paid(user_id):
-            used = self.request_counts.get(user_id, 0)
+        if not record["paid"]:
+            used = await self.trial_counter.get(user_id)
+            if used is None:
+                # база недоступна и счётчик неизвестен — не считаем его нулём
+                logging.warning(f"Пробный счётчик пользователя {user_id} недоступен")
+                if not is_inline:
+                    await update.message.reply_text(
+                        "⚠️ Не удалось проверить лимит пробных запросов. Попробуйте позже."
+                    )
+                return False
             if used >= self.free_request_limit:
                 logging.info(
                     f"Пользователь {user_id} исчерпал пробный лимит "
@@ -199,17 +228,17 @@ class ChatGPTTelegramBot:
                 )
                 await self.send_budget_reached_message(update, context, is_inline)
                 return False
-            # учитываем этот запрос
-            self.request_counts[user_id] = used + 1
+            # учитываем этот запрос (запишется в базу пакетом при следующем сбросе)
+            self.trial_counter.increment(user_id)
 
         # 3) Проверка общих прав (is_allowed)
-        if not await is_allowed(self.config, update, context, is_inline=is_inline):
+        if not await is_allowed(self.config, update, context, is_inline=is_inline, access_record=record):
             logging.warning(f"User {user_name} (id: {user_id}) не имеет прав")
             await self.send_disallowed_message(update, context, is_inline)
             return False
 
         # 4) Проверка бюджета OpenAI (is_within_budget)
-        if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
+        if not await is_within_budget(self.config, self.usage, update, is_inline=is_inline):
             logging.warning(f"User {user_name} (id: {user_id}) достиг лимита OpenAI")
             await self.send_budget_reached_message(update, context, is_inline)
             return False
@@ -316,7 +345,6 @@ class ChatGPTTelegramBot:
         if not await self.check_access(update):
             user = update.message.from_user
             logging.warning(f'User {user.name} (id: {user.id}) is not allowed to request their usage statistics')
-            await self.send_disallowed_message(update, context)
             return
 
         user = update.message.from_user
@@ -365,7 +393,7 @@ class ChatGPTTelegramBot:
         )
 
         # Budget
-        remaining_budget = get_remaining_budget(self.config, self.usage, update)
+        remaining_budget = await get_remaining_budget(self.config, self.usage, update)
         text_budget = "\n\n"
         if remaining_budget < float('inf'):
             period = self.config['budget_period']
@@ -385,7 +413,6 @@ class ChatGPTTelegramBot:
         if not await self.check_access(update):
             logging.warning(f'User {update.message.from_user.name}  (id: {update.message.from_user.id})'
                         ' is not allowed to resend the message')
-            await self.send_disallowed_message(update, context)
             return
 
 
@@ -414,7 +441,6 @@ class ChatGPTTelegramBot:
         if not await self.check_access(update):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                         'is not allowed to reset the conversation')
-            await self.send_disallowed_message(update, context)
             return
 
         logging.info(f'Resetting the conversation for user {update.message.from_user.name} '
@@ -434,7 +460,6 @@ class ChatGPTTelegramBot:
         """
     # Проверка доступа пользователя
         if not await self.check_access(update):
-            await self.send_disallowed_message(update, context)
             return
 
         if not self.config['enable_image_generation'] \
@@ -455,7 +480,6 @@ class ChatGPTTelegramBot:
 
         async def _generate():
             if not await self.check_access(update):
-                await self.send_disallowed_message(update, context)
                 return
             try:
                 image_url, image_size = await self.openai.generate_image(prompt=image_query)
@@ -494,7 +518,6 @@ class ChatGPTTelegramBot:
         Generates speech for the given input using TTS APIs.
         """
         if not await self.check_access(update):
-            await self.send_disallowed_message(update, context)
             return
 
         if not self.config['enable_tts_generation'] or not await self.check_allowed_and_within_budget(update, context):
@@ -553,7 +576,6 @@ class ChatGPTTelegramBot:
         Transcribe audio messages.
         """
         if not await self.check_access(update):
-            await self.send_disallowed_message(update, context)
             return
 
         if not self.config['enable_transcription'] or not await self.check_allowed_and_within_budget(update, context):
@@ -677,7 +699,6 @@ class ChatGPTTelegramBot:
         Interpret image using vision model.
         """
         if not await self.check_access(update):
-            await self.send_disallowed_message(update, context)
             return
         if not self.config['enable_vision'] or not await self.check_allowed_and_within_budget(update, context):
             return
@@ -878,7 +899,6 @@ class ChatGPTTelegramBot:
             return
         
         if not await self.check_access(update):
-            await self.send_disallowed_message(update, context)
             return
 
         logging.info(
@@ -1099,7 +1119,7 @@ class ChatGPTTelegramBot:
 
         # 1) Начало диалога / выбор подачи заявки
         if callback_data == "start_dialog":
-            if self.supabase.is_user_approved(user_id):
+            if await self.supabase.is_user_approved(user_id):
                 keyboard = [
                     [InlineKeyboardButton("👨‍🏫/👩‍🏫 Преподаватель", callback_data="role_teacher")],
                     [InlineKeyboardButton("👨‍🎓/👩‍🎓 Ученик",       callback_data="role_student")],
@@ -1109,14 +1129,13 @@ class ChatGPTTelegramBot:
                 )
                 return
 
-            pending = self.supabase.get_pending_requests()
-            if any(req.get("user_id") == user_id for req in pending):
+            if await self.supabase.has_pending_request(user_id):
                 await query.answer("Вы уже подали заявку. Ожидайте одобрения администратора.", show_alert=True)
                 return
 
             try:
                 # Сохраняем заявку в базе
-                self.supabase.add_join_request(user_id, username)
+                await self.supabase.add_join_request(user_id, username)
 
                 # 1) всплывающее уведомление (необязательно, можно убрать)
                 await query.answer("✅ Заявка отправлена.", show_alert=True)
@@ -1145,7 +1164,7 @@ class ChatGPTTelegramBot:
             return
 
         # 2) Всё остальное — только для одобренных
-        if not self.supabase.is_user_approved(user_id):
+        if not await self.supabase.is_user_approved(user_id):
             await query.answer(
                 "⛔️ Доступ запрещён. Подайте заявку и дождитесь одобрения администратора.",
                 show_alert=True
@@ -1300,6 +1319,27 @@ class ChatGPTTelegramBot:
                 self.admin_commands,
                 scope=BotCommandScopeChat(chat_id=admin_id)
             )
+        # 3) фоновое обновление снимка доступа на случай недоступности Supabase
+        application.create_task(
+            self.supabase.run_snapshot_refresher(self.config.get('access_snapshot_interval', 300))
+        )
+        # 4) периодический сброс счётчиков пробных запросов в базу
+        application.create_task(
+            self.trial_counter.run_flusher(self.config.get('trial_flush_interval', 10))
+        )
+        # 5) сворачивание старой истории расходов в помесячные записи
+        if self.config.get('usage_retention_months', 0) > 0:
+            application.create_task(run_usage_compactor(
+                self.usage, self.config['usage_retention_months'],
+                self.config.get('usage_compaction_interval', 86400)
+            ))
+
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Flushes buffered state before the bot exits.
+        """
+        await self.trial_counter.flush()
+        await asyncio.get_running_loop().run_in_executor(None, flush_usage_stores)
 
     def run(self):
         """
@@ -1310,12 +1350,15 @@ class ChatGPTTelegramBot:
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
             .build()
 
         # Добавляем обработчики команд
         application.add_handler(CommandHandler('admin', self.admin_panel))
         application.add_handler(CommandHandler('all', self.broadcast, filters=filters.User(self.admin_user_ids)))
+        application.add_handler(CommandHandler('metrics', self.metrics, filters=filters.User(self.admin_user_ids)))
+        application.add_handler(CommandHandler('analytics', self.analytics, filters=filters.User(self.admin_user_ids)))
         application.add_handler(CallbackQueryHandler(self.handle_admin_buttons, pattern="^admin_"))
         application.add_handler(CommandHandler('reset', self.reset))
         application.add_handler(CommandHandler("image_search", self.image_search))
@@ -1359,10 +1402,11 @@ class ChatGPTTelegramBot:
         username = user.username or user.full_name
 
         # Асинхронно проверяем одобрение пользователя
-        if not self.supabase.is_user_approved(user_id):
-            # Асинхронно получаем заявки
-            requests = self.supabase.get_pending_requests()
-            if any(str(user_id) == str(req.get("user_id")) for req in requests):
+        record = await self.supabase.get_access_record(user_id)
+        if not record["approved"]:
+            if not self.supabase.shield.allow_reply(user_id):
+                return
+            if await self.supabase.has_pending_request(user_id):
                 await update.message.reply_text("Вы уже подали заявку. Ожидайте одобрения администратора.")
             else:
                 keyboard = InlineKeyboardMarkup([
@@ -1374,7 +1418,7 @@ class ChatGPTTelegramBot:
                 )
             return
 
-        if not await is_allowed(self.config, update, _):
+        if not await is_allowed(self.config, update, _, access_record=record):
             logging.warning(f'User {update.effective_user.full_name} (id: {user_id}) is not allowed to use /help')
             await self.send_disallowed_message(update, _)
             return
@@ -1415,10 +1459,11 @@ class ChatGPTTelegramBot:
         await query.answer()
 
         # 1) Список участников
-        if data == "admin_list_users":
-            users = self.supabase.get_users()
+        if data.startswith("admin_list_users"):
+            users, nav = await self.admin_page(data, "admin_list_users", self.supabase.get_users_page, "id", str)
             keyboard = []
-            for uid, rec in users.items():
+            for rec in users:
+                uid = rec.get("id")
                 username = rec.get("username", "Без имени")
                 keyboard.append([
                     InlineKeyboardButton("🚫 Заблокировать", callback_data=f"block_user_{uid}"),
@@ -1429,19 +1474,21 @@ class ChatGPTTelegramBot:
             else:
                 await query.edit_message_text(
                     "📋 Список участников:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=InlineKeyboardMarkup(keyboard + nav)
                 )
             return
 
         # 2) Заявки на вступление
-        if data == "admin_view_requests":
-            requests = self.supabase.get_requests()
+        if data.startswith("admin_view_requests"):
+            requests, nav = await self.admin_page(data, "admin_view_requests", self.supabase.get_requests_page,
+                                                  "user_id", int)
             if not requests:
                 await query.edit_message_text("Заявок нет.")
                 return
 
             keyboard = []
-            for uid, info in requests.items():
+            for info in requests:
+                uid = info.get("user_id")
                 username = info.get("username")
                 if username:
                     mention_btn = InlineKeyboardButton(
@@ -1459,15 +1506,31 @@ class ChatGPTTelegramBot:
                     mention_btn
                 ])
 
+            approve_all = [InlineKeyboardButton("✅ Одобрить все заявки", callback_data="admin_approve_all")]
             await query.edit_message_text(
                 "📝 Заявки на вступление:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=InlineKeyboardMarkup(keyboard + nav + [approve_all])
             )
             return
 
+        # 2a) Одобрить все заявки одним запросом
+        if data == "admin_approve_all":
+            approved = await self.supabase.approve_all_pending()
+            for row in approved:
+                try:
+                    await context.bot.send_message(
+                        chat_id=int(row["user_id"]),
+                        text="✅ Ваша заявка одобрена! Теперь вы можете пользоваться ботом."
+                    )
+                except Exception as e:
+                    logging.error(f"Не удалось уведомить пользователя {row['user_id']}: {e}")
+            await query.edit_message_text(f"✅ Одобрено заявок: {len(approved)}.")
+            return
+
         # 3) Заблокированные пользователи
-        if data == "admin_blocked_users":
-            blocked = self.supabase.get_blocked_users()
+        if data.startswith("admin_blocked_users"):
+            blocked, nav = await self.admin_page(data, "admin_blocked_users", self.supabase.get_blocked_users_page,
+                                                 "user_id", int)
             if not blocked:
                 await query.edit_message_text("Заблокированных пользователей нет.")
                 return
@@ -1482,17 +1545,17 @@ class ChatGPTTelegramBot:
                     InlineKeyboardButton("🔓 Разблокировать", callback_data=f"unblock_user_{uid}")
                 ])
             text = "🚫 Заблокированные пользователи:\n\n" + "\n".join(text_lines)
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard + nav))
             return
 
         # 4) Одобрить заявку
         if data.startswith("approve_request_"):
             str_uid = data.split("_")[-1]
             user_id = int(str_uid)
-            requests = self.supabase.get_requests()
-            username = requests.get(str_uid, {}).get("username", "")
+            request = await self.supabase.get_request(user_id)
+            username = (request or {}).get("username", "")
             try:
-                self.supabase.approve_user(user_id, username)
+                await self.supabase.approve_user(user_id, username)
                 await context.bot.send_message(
                     chat_id=user_id,
                     text="✅ Ваша заявка одобрена! Теперь вы можете пользоваться ботом."
@@ -1508,7 +1571,7 @@ class ChatGPTTelegramBot:
             str_uid = data.split("_")[-1]
             user_id = int(str_uid)
             try:
-                self.supabase.reject_user(user_id)
+                await self.supabase.reject_user(user_id)
                 await context.bot.send_message(
                     chat_id=user_id,
                     text="❌ Ваша заявка отклонена."
@@ -1524,7 +1587,7 @@ class ChatGPTTelegramBot:
             str_uid = data.split("_")[-1]
             user_id = int(str_uid)
             try:
-                self.supabase.block_user(user_id)
+                await self.supabase.block_user(user_id)
                 await context.bot.send_message(
                     chat_id=user_id,
                     text="🚫 Вы были заблокированы и больше не можете использовать этого бота."
@@ -1537,7 +1600,7 @@ class ChatGPTTelegramBot:
 
         if data.startswith("unblock_user_"):
             user_id = int(data.split("_")[-1])
-            self.supabase.unblock_user(user_id)
+            await self.supabase.unblock_user(user_id)
             await query.edit_message_text("Пользователь разблокирован.")
             return
 
@@ -1549,6 +1612,30 @@ class ChatGPTTelegramBot:
         else:
             await query.edit_message_text(f"Неизвестное действие: {data}")
     
+    async def admin_page(self, data: str, prefix: str, fetch, key: str, cursor_type):
+        """
+        Loads one keyset page for an admin list view.
+        Callback data is "<prefix>", "<prefix>:>cursor" (next page) or "<prefix>:<cursor" (previous page).
+        :return: the rows of the page and the keyboard rows with the paging buttons
+        """
+        after = before = None
+        _, _, cursor = data.partition(":")
+        if cursor.startswith(">"):
+            after = cursor_type(cursor[1:])
+        elif cursor.startswith("<"):
+            before = cursor_type(cursor[1:])
+
+        rows, has_more = await fetch(after=after, before=before, limit=self.admin_page_size)
+        has_prev = has_more if before is not None else after is not None
+        has_next = has_more if before is None else True
+
+        buttons = []
+        if rows and has_prev:
+            buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{prefix}:<{rows[0][key]}"))
+        if rows and has_next:
+            buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"{prefix}:>{rows[-1][key]}"))
+        return rows, [buttons] if buttons else []
+
     async def admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         if not is_admin(self.config, user_id):
@@ -1576,12 +1663,10 @@ class ChatGPTTelegramBot:
 
         text = " ".join(context.args)
 
-        # 3) Получаем всех одобренных пользователей
-        users = self.supabase.get_users()  # возвращает { '12345': {...}, '67890': {...}, ... }
+        # 3) Постранично перебираем одобренных пользователей
         count = 0
-        for uid_str, record in users.items():
-            if record.get("status") != "approved":
-                continue
+        async for record in self.supabase.iter_users(status="approved"):
+            uid_str = record.get("id")
             try:
                 await context.bot.send_message(chat_id=int(uid_str), text=text)
                 count += 1
@@ -1591,6 +1676,104 @@ class ChatGPTTelegramBot:
         # 4) Отчёт в чат админа
         await update.message.reply_text(f"✅ Рассылка выполнена: отправлено {count} сообщения(й).")
 
+    async def metrics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Shows internal counters to admins.
+        """
+        if not is_admin(self.config, update.effective_user.id):
+            await update.message.reply_text("❌ У вас нет прав администратора.")
+            return
+
+        cache_stats = self.supabase.cache.stats()
+        shield_stats = self.supabase.shield.stats()
+        breaker_stats = self.supabase.breaker.stats()
+        snapshot_stats = self.supabase.snapshot.stats()
+        snapshot_age = f"{snapshot_stats['age']:.0f} с" if snapshot_stats['age'] is not None else "нет"
+        lines = [
+            "📊 Кэш доступа:",
+            f"записей: {cache_stats['size']} / {cache_stats['max_size']}",
+            f"попаданий: {cache_stats['hits']}, промахов: {cache_stats['misses']} "
+            f"({cache_stats['hit_rate']:.1%})",
+            f"вытеснено: {cache_stats['evictions']}",
+            "",
+            "🛡 Кэш отказов:",
+            f"записей: {shield_stats['size']} / {shield_stats['max_size']}",
+            f"отказов без запроса к базе: {shield_stats['hits']}",
+            f"ответов подавлено: {shield_stats['throttled']}, вытеснено: {shield_stats['evictions']}",
+            "",
+            f"⚡️ Circuit breaker: {breaker_stats['state']}",
+            f"ошибок подряд: {breaker_stats['failures']}, размыканий: {breaker_stats['times_opened']}, "
+            f"запросов в обход базы: {breaker_stats['short_circuited']}",
+            f"снимок доступа: {snapshot_stats['approved']} одобр., {snapshot_stats['paid']} оплат., "
+            f"{snapshot_stats['blocked']} заблок., возраст {snapshot_age}, ответов из снимка: {snapshot_stats['served']}",
+        ]
+        pool_stats = get_pool_stats()
+        lines += [
+            "",
+            "🔌 Пул Supabase:",
+            f"клиентов создано: {pool_stats['clients_created']}",
+            f"соединений: {pool_stats['open_connections']} / {pool_stats['pool_size']}",
+            f"запросов: {pool_stats['requests']} (в работе: {pool_stats['in_flight']}, "
+            f"ошибок: {pool_stats['errors']})",
+            f"средняя задержка: {pool_stats['avg_latency_ms']:.1f} мс",
+            f"очередь потоков: {pool_stats['executor_queue']}",
+        ]
+        usage_stats = self.usage.stats()
+        lines += [
+            "",
+            "🧮 Трекеры расходов:",
+            f"в памяти: {usage_stats['size']} / {usage_stats['max_size']}",
+            f"записей истории: {usage_stats['entries']} / {usage_stats['max_entries']}",
+            f"вытеснено: {usage_stats['evictions']}, загружено повторно: {usage_stats['loads']}",
+            "хранилище: " + ", ".join(f"{key}={value}" for key, value in get_usage_store().stats().items()),
+        ]
+        ledger_stats = get_budget_ledger(self.config).stats()
+        lines += [
+            "",
+            "💳 Остатки бюджета:",
+            f"записей: {ledger_stats['size']}, из памяти: {ledger_stats['hits']}, "
+            f"пересчётов: {ledger_stats['misses']} ({ledger_stats['hit_rate']:.1%})",
+        ]
+        tokenizer_stats = get_tokenizer_stats()
+        lines += [
+            "",
+            "🔤 Подсчёт токенов:",
+            f"кодировок загружено: {tokenizer_stats['encodings_loaded']}",
+            f"сообщений подсчитано: {tokenizer_stats['messages']}",
+            f"время: {tokenizer_stats['seconds'] * 1000:.1f} мс "
+            f"(в среднем {tokenizer_stats['avg_message_ms']:.2f} мс на сообщение)",
+        ]
+        await update.message.reply_text("\n".join(lines))
+
+    async def analytics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Shows the top users by cost this month and the daily token trend to admins.
+        Usage: /analytics [N]
+        """
+        if not is_admin(self.config, update.effective_user.id):
+            await update.message.reply_text("❌ У вас нет прав администратора.")
+            return
+
+        limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+        ttl = self.config.get('analytics_cache_ttl', 600)
+        if self.usage_columns is None or time.monotonic() - self.usage_columns[0] > ttl:
+            # загрузка всех расходов блокирующая, выполняем её в пуле потоков
+            columns = await asyncio.get_running_loop().run_in_executor(
+                None, load_columns, unit_prices(self.config)
+            )
+            self.usage_columns = (time.monotonic(), columns)
+        columns = self.usage_columns[1]
+
+        lines = [f"💰 Топ-{limit} по расходам за месяц:"]
+        for place, (user_id, cost) in enumerate(columns.top_users_by_cost(limit=limit), start=1):
+            lines.append(f"{place}. {user_id} — ${cost:.2f}")
+        lines += ["", "📈 Токены по дням:"]
+        for day, tokens in columns.daily_trend("chat_tokens", days=14):
+            lines.append(f"{day}: {int(tokens)}")
+        lines += ["", f"пользователей: {len(columns.users)}, записей: {len(columns)}, "
+                      f"загрузка {columns.load_seconds:.1f} с, расчёт: {columns.engine}"]
+        await update.message.reply_text("\n".join(lines))
+
     def set_dynamic_prompt(self, chat_id: int):
         """
         Сбрасывает историю и ставит системное сообщение
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from circuit_breaker import CircuitBreaker
+
+
+class TrialCounter:
+    """
+    Persistent counter of free trial requests per user.
+    Reads are served from a local cache, increments are applied locally at once
+    and written behind to the database in batches by flush(). The database adds
+    the increments atomically, so several bot processes can share the counters.
+    Reads go through the access circuit breaker: while the database is failing,
+    cached counts are served past their TTL and unknown counts are reported as None.
+    """
+
+    def __init__(self, db, cache_ttl: float = 60.0, breaker: CircuitBreaker = None, max_size: int = 10000):
+        """
+        Initializes the counter.
+        :param db: AsyncSupabaseClient (or compatible) providing get_trial_requests/increment_trial_requests
+        :param cache_ttl: seconds after which a user's count is re-read from the database
+        :param breaker: circuit breaker guarding the database reads, e.g. the access breaker
+        :param max_size: maximum number of users whose counts are cached, the least recently used is evicted
+        """
+        self.db = db
+        self.cache_ttl = cache_ttl
+        self.breaker = breaker or CircuitBreaker("trial_requests")
+        self.max_size = max_size
+        self.counts: OrderedDict[int, tuple[int, float]] = OrderedDict()  # {user_id: (used, loaded_at)}
+        self.pending: dict[int, int] = {}  # {user_id: increments not yet flushed}
+        self.flushing: dict[int, int] = {}  # increments being written right now
+        self.flush_lock = asyncio.Lock()
+
+    def _store(self, user_id: int, used: int, loaded_at: float):
+        self.counts[user_id] = (used, loaded_at)
+        self.counts.move_to_end(user_id)
+        while len(self.counts) > self.max_size:
+            self.counts.popitem(last=False)
+
+    async def get(self, user_id: int) -> int | None:
+        """
+        Returns the number of trial requests used by the user,
+        or None if it is unknown because the database is unavailable.
+        """
+        cached = self.counts.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < self.cache_ttl:
+            self.counts.move_to_end(user_id)
+            return cached[0]
+        if not self.breaker.allow():
+            return cached[0] if cached is not None else None
+        try:
+            stored = await self.db.get_trial_requests(user_id)
+        except Exception as e:
+            logging.warning(f'Failed to load trial requests of user {user_id}: {e}')
+            self.breaker.record_failure()
+            if cached is None:
+                return None
+            # served until the next TTL instead of querying the failing database on every message
+            self._store(user_id, cached[0], time.monotonic())
+            return cached[0]
+        self.breaker.record_success()
+        used = stored + self.pending.get(user_id, 0) + self.flushing.get(user_id, 0)
+        self._store(user_id, used, time.monotonic())
+        return used
+
+    def increment(self, user_id: int):
+        """
+        Counts one trial request locally; it is persisted on the next flush.
+        """
+        cached = self.counts.get(user_id)
+        if cached is not None:
+            # an unknown count stays unknown: it is read from the database plus pending
+            self.counts[user_id] = (cached[0] + 1, cached[1])
+        self.pending[user_id] = self.pending.get(user_id, 0) + 1
+
+    async def flush(self):
+        """
+        Writes all pending increments to the database in one call.
+        Increments are kept for the next attempt if the write fails.
+        """
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, {}
+            try:
+                await self.db.increment_trial_requests(self.flushing)
+            except Exception as e:
+                logging.warning(f'Failed to flush trial requests: {e}')
+                for user_id, delta in self.flushing.items():
+                    self.pending[user_id] = self.pending.get(user_id, 0) + delta
+            finally:
+                self.flushing = {}
+
+    async def run_flusher(self, interval: float):
+        """
+        Background task flushing pending increments every `interval` seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
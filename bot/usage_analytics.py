@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from array import array
+from datetime import date, timedelta
+
+from dotenv import load_dotenv
+
+from usage_store import SQLiteUsageStore, get_usage_store
+from usage_tracker import UsageTracker, year_month
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+IMAGE_SIZES = ["256x256", "512x512", "1024x1024"]
+TTS_MODELS = ['tts-1', 'tts-1-hd']
+
+# usage categories: one per usage kind, images split by size and tts by model, as they are priced
+CATEGORIES = ["chat_tokens", "transcription_seconds", "vision_tokens"] + \
+             [f"number_images:{index}" for index in range(len(IMAGE_SIZES))] + \
+             [f"tts_characters:{model}" for model in TTS_MODELS]
+CATEGORY_KINDS = [category.split(":")[0] for category in CATEGORIES]
+
+
+def unit_prices(config: dict) -> list[float]:
+    """
+    USD price of one unit of every category, priced like UsageTracker.initialize_all_time_cost:
+    tokens per 1000, transcription per minute, images per image, tts per 1000 characters
+    (without the per-request rounding of the add_* methods).
+    :param config: bot config with token_price, transcription_price, vision_token_price, image_prices, tts_prices
+    """
+    return [config['token_price'] / 1000, config['transcription_price'] / 60, config['vision_token_price'] / 1000] + \
+        [float(price) for price in config['image_prices']] + \
+        [float(price) / 1000 for price in config['tts_prices']]
+
+
+def prices_from_env() -> dict:
+    return {
+        'token_price': float(os.environ.get('TOKEN_PRICE', 0.002)),
+        'image_prices': [float(i) for i in os.environ.get('IMAGE_PRICES', "0.016,0.018,0.02").split(",")],
+        'vision_token_price': float(os.environ.get('VISION_TOKEN_PRICE', '0.01')),
+        'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
+        'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
+    }
+
+
+class UsageColumns:
+    """
+    Usage of all users as parallel columns, one row per (user, day, category):
+    user index, day index, category index, amount and cost. Days are indexed in sorted
+    order, monthly buckets left by compaction ('YYYY-MM') are kept as days of their month.
+    Aggregates use NumPy when it is installed and plain loops over the arrays otherwise.
+    """
+
+    def __init__(self, prices: list[float]):
+        self.prices = prices
+        self.users: list[str] = []
+        self.user_index: dict[str, int] = {}
+        self.day_index: dict[str, int] = {}
+        self.user = array('l')
+        self.day = array('l')
+        self.category = array('l')
+        self.amount = array('d')
+        self.days: list[str] = []
+        self.load_seconds = 0.0
+
+    def add(self, user_id: str, day: str, category: int, amount):
+        index = self.user_index.get(user_id)
+        if index is None:
+            index = self.user_index[user_id] = len(self.users)
+            self.users.append(user_id)
+        day_code = self.day_index.get(day)
+        if day_code is None:
+            day_code = self.day_index[day] = len(self.day_index)
+        self.user.append(index)
+        self.day.append(day_code)
+        self.category.append(category)
+        self.amount.append(float(amount))
+
+    def add_usage(self, user_id: str, usage: dict):
+        """
+        Adds the usage_history of one user in the UsageTracker format.
+        """
+        history = usage["usage_history"]
+        for kind in ("chat_tokens", "transcription_seconds", "vision_tokens"):
+            category = CATEGORIES.index(kind)
+            for day, amount in history.get(kind, {}).items():
+                self.add(user_id, day, category, amount)
+        for day, images in history.get("number_images", {}).items():
+            for size, count in enumerate(images):
+                if count:
+                    self.add(user_id, day, CATEGORIES.index(f"number_images:{size}"), count)
+        for model, model_history in history.get("tts_characters", {}).items():
+            category = CATEGORIES.index(f"tts_characters:{model}")
+            for day, characters in model_history.items():
+                self.add(user_id, day, category, characters)
+
+    def finish(self):
+        """
+        Sorts day codes chronologically and builds the derived columns.
+        """
+        self.days = sorted(self.day_index)
+        remap = array('l', [0] * len(self.days))
+        for position, day in enumerate(self.days):
+            remap[self.day_index[day]] = position
+        self.day = array('l', (remap[code] for code in self.day))
+        self.day_index = {day: position for position, day in enumerate(self.days)}
+        self.months = sorted({year_month(day) for day in self.days})
+        month_index = {month: position for position, month in enumerate(self.months)}
+        self.day_month = array('l', (month_index[year_month(day)] for day in self.days))
+        if np is not None:
+            # zero-copy views of the arrays
+            int_type = np.dtype(f"i{self.user.itemsize}")
+            self.np_user = np.frombuffer(self.user, dtype=int_type)
+            self.np_day = np.frombuffer(self.day, dtype=int_type)
+            self.np_category = np.frombuffer(self.category, dtype=int_type)
+            self.np_amount = np.frombuffer(self.amount, dtype=np.float64)
+            self.np_cost = self.np_amount * np.array(self.prices)[self.np_category]
+            self.np_month = np.frombuffer(self.day_month, dtype=int_type)[self.np_day]
+        return self
+
+    def __len__(self):
+        return len(self.amount)
+
+    @property
+    def engine(self) -> str:
+        return 'numpy' if np is not None else 'array'
+
+    def top_users_by_cost(self, month: str = None, limit: int = 50) -> list[tuple[str, float]]:
+        """
+        Users with the highest cost in a month ('YYYY-MM', defaults to the current month).
+        """
+        month = month or year_month(date.today())
+        if month not in self.months:
+            return []
+        month_code = self.months.index(month)
+        if np is not None:
+            mask = self.np_month == month_code
+            costs = np.bincount(self.np_user[mask], weights=self.np_cost[mask], minlength=len(self.users))
+            top = np.argsort(-costs)[:limit]
+            return [(self.users[i], float(costs[i])) for i in top if costs[i] > 0]
+        costs = [0.0] * len(self.users)
+        for user, day, category, amount in zip(self.user, self.day, self.category, self.amount):
+            if self.day_month[day] == month_code:
+                costs[user] += amount * self.prices[category]
+        top = sorted(range(len(costs)), key=lambda i: -costs[i])[:limit]
+        return [(self.users[i], costs[i]) for i in top if costs[i] > 0]
+
+    def daily_trend(self, kind: str = "chat_tokens", days: int = 30, today: date = None) -> list[tuple[str, float]]:
+        """
+        Daily total amount of a usage kind over all users for the last `days` days.
+        """
+        today = today or date.today()
+        wanted = [str(today - timedelta(days=offset)) for offset in range(days - 1, -1, -1)]
+        categories = [index for index, category_kind in enumerate(CATEGORY_KINDS) if category_kind == kind]
+        totals = [0.0] * len(self.days)
+        if np is not None and len(self.days):
+            mask = np.isin(self.np_category, categories)
+            totals = np.bincount(self.np_day[mask], weights=self.np_amount[mask], minlength=len(self.days))
+        else:
+            for day, category, amount in zip(self.day, self.category, self.amount):
+                if category in categories:
+                    totals[day] += amount
+        return [(day, float(totals[self.day_index[day]]) if day in self.day_index else 0.0) for day in wanted]
+
+
+def load_columns(prices: list[float], store=None) -> UsageColumns:
+    """
+    Loads the usage of all users from the store into columns. Guest shards are skipped.
+    """
+    store = store or get_usage_store()
+    started = time.perf_counter()
+    columns = UsageColumns(prices)
+    if isinstance(store, SQLiteUsageStore):
+        store.flush_all()
+        # the read connection: the scan must not hold the writer's lock and stall charge commits
+        with store.read_lock:
+            rows = store.reads.execute(
+                "select user_id, day, kind || ':' || variant, amount from usage where user_id not like 'guests%'"
+            ).fetchall()
+        # hot loop: 100k users are millions of rows, so the work of add() is inlined here
+        category_index = {category if ":" in category else f"{category}:": index
+                          for index, category in enumerate(CATEGORIES)}
+        user_index, day_index, users = columns.user_index, columns.day_index, columns.users
+        user_codes, day_codes = array('l'), array('l')
+        for user_id, day, _, _ in rows:
+            code = user_index.get(user_id)
+            if code is None:
+                code = user_index[user_id] = len(users)
+                users.append(user_id)
+            user_codes.append(code)
+            day_code = day_index.get(day)
+            if day_code is None:
+                day_code = day_index[day] = len(day_index)
+            day_codes.append(day_code)
+        columns.user, columns.day = user_codes, day_codes
+        columns.category = array('l', [category_index[row[2]] for row in rows])
+        columns.amount = array('d', [row[3] for row in rows])
+    else:
+        for user_id in store.user_ids():
+            if user_id.startswith("guests"):
+                continue
+            columns.add_usage(user_id, UsageTracker(user_id, None, store=store).usage)
+    columns.finish()
+    columns.load_seconds = time.perf_counter() - started
+    return columns
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Usage analytics over all users.")
+    parser.add_argument("--logs-dir", default="usage_logs", help="directory of the JSON usage logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    top = commands.add_parser("top", help="top users by cost in a month")
+    top.add_argument("--month", help="YYYY-MM, defaults to the current month")
+    top.add_argument("--limit", type=int, default=50)
+    trend = commands.add_parser("trend", help="daily usage of one kind over all users")
+    trend.add_argument("--kind", default="chat_tokens", choices=sorted(set(CATEGORY_KINDS)))
+    trend.add_argument("--days", type=int, default=30)
+    args = parser.parse_args()
+
+    columns = load_columns(unit_prices(prices_from_env()), get_usage_store(args.logs_dir))
+    started = time.perf_counter()
+    if args.command == "top":
+        for place, (user_id, cost) in enumerate(columns.top_users_by_cost(args.month, args.limit), start=1):
+            print(f"{place:>3}. {user_id}: ${cost:.4f}")
+    else:
+        for day, amount in columns.daily_trend(args.kind, args.days):
+            print(f"{day}: {amount:g}")
+    print(f"{len(columns.users)} users, {len(columns)} rows, loaded in {columns.load_seconds:.2f} s, "
+          f"computed in {(time.perf_counter() - started) * 1000:.1f} ms ({columns.engine})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+from usage_tracker import UsageTracker
+
+
+class UsageTrackerCache:
+    """
+    Dict-like container of live UsageTracker objects bounded by number of trackers
+    and by the total number of history entries they hold. The least recently used
+    tracker is flushed to its store and evicted first; accessing an evicted user
+    loads the tracker again from the store. Pinned keys (e.g. "guests") are never evicted.
+    """
+
+    def __init__(self, max_size: int = 10000, max_entries: int = 2000000, pinned=("guests",)):
+        """
+        Initializes the cache.
+        :param max_size: maximum number of resident trackers
+        :param max_entries: maximum number of history entries held by all resident trackers
+        :param pinned: keys that are never evicted
+        """
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.pinned = set(pinned)
+        self.trackers: OrderedDict = OrderedDict()
+        self.sizes: dict = {}
+        self.entries = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.trackers
+
+    def __len__(self) -> int:
+        return len(self.trackers)
+
+    def __iter__(self):
+        return iter(list(self.trackers))
+
+    def __getitem__(self, key) -> UsageTracker:
+        tracker = self.trackers.get(key)
+        if tracker is None:
+            # evicted earlier: reload from the store
+            self.loads += 1
+            tracker = UsageTracker(key, None)
+        self[key] = tracker
+        return tracker
+
+    def __setitem__(self, key, tracker: UsageTracker):
+        self.trackers[key] = tracker
+        self.trackers.move_to_end(key)
+        # approximate memory footprint of the tracker
+        size = tracker.history_entries()
+        self.entries += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        self._evict(keep=key)
+
+    def get(self, key, default=None):
+        return self.trackers.get(key, default)
+
+    def items(self):
+        return list(self.trackers.items())
+
+    def values(self):
+        return list(self.trackers.values())
+
+    def pop(self, key, default=None):
+        tracker = self.trackers.pop(key, None)
+        if tracker is None:
+            return default
+        self.entries -= self.sizes.pop(key, 0)
+        if isinstance(tracker, UsageTracker):
+            tracker.store.flush(tracker)
+        return tracker
+
+    def _evict(self, keep=None):
+        while len(self.trackers) > self.max_size or self.entries > self.max_entries:
+            victim = next((key for key in self.trackers if key not in self.pinned and key != keep), None)
+            if victim is None:
+                return
+            self.pop(victim)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.trackers),
+            'max_size': self.max_size,
+            'entries': self.entries,
+            'max_entries': self.max_entries,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
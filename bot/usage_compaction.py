@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+
+from usage_store import SQLiteUsageStore, get_usage_store, flush_usage_stores
+from usage_tracker import UsageTracker, year_month
+
+
+def cutoff_month(keep_months: int, today: date = None) -> str:
+    """
+    Returns the first month ('YYYY-MM') whose days are kept; days of earlier months are rolled up.
+    :param keep_months: number of months kept with per-day entries, the current month included
+    """
+    today = today or date.today()
+    months = today.year * 12 + today.month - 1 - (keep_months - 1)
+    return f"{months // 12:04d}-{months % 12 + 1:02d}"
+
+
+def compact_history(usage: dict, cutoff: str) -> int:
+    """
+    Rolls per-day entries of months before cutoff into monthly 'YYYY-MM' buckets.
+    Amounts are summed, so monthly and all-time totals stay exact.
+    :return: number of history entries removed
+    """
+    history = usage["usage_history"]
+    before = after = 0
+
+    def roll(days: dict, merge):
+        nonlocal before, after
+        old = [day for day in days if len(day) > 7 and day < cutoff]
+        before += len(old)
+        for day in old:
+            month = year_month(day)
+            if month not in days:
+                after += 1
+            days[month] = merge(days.get(month), days.pop(day))
+
+    add = lambda bucket, amount: amount if bucket is None else bucket + amount
+    add_sizes = lambda bucket, images: list(images) if bucket is None else [a + b for a, b in zip(bucket, images)]
+    for kind, days in history.items():
+        if kind == "tts_characters":
+            for model_history in days.values():
+                roll(model_history, add)
+        elif kind == "number_images":
+            roll(days, add_sizes)
+        else:
+            roll(days, add)
+    return before - after
+
+
+def timed_load(store, user_id) -> tuple[UsageTracker, float]:
+    """
+    Loads a user's tracker from the store and measures how long it takes.
+    """
+    started = time.perf_counter()
+    tracker = UsageTracker(user_id, None, store=store)
+    return tracker, time.perf_counter() - started
+
+
+def resident_tracker(trackers, user_id: str):
+    """
+    Finds the live tracker of a stored user ID in the bot's tracker cache, if any.
+    """
+    if trackers is None:
+        return None
+    if user_id.startswith("guests"):
+        guests = trackers.get("guests")
+        for shard in getattr(guests, "shards", []):
+            if shard.user_id == user_id:
+                return shard
+        return None
+    if user_id.lstrip("-").isdigit():
+        return trackers.get(int(user_id))
+    return trackers.get(user_id)
+
+
+async def compact_usage(store, keep_months: int, trackers=None, today: date = None) -> list[dict]:
+    """
+    Compacts the usage history of every user in the store.
+    Blocking reads run in the default executor; live trackers are changed on the event loop
+    and persisted through their store, so the bot keeps serving while this runs.
+    :param trackers: the bot's tracker cache, its live trackers are compacted in place
+    :return: one report per compacted user
+    """
+    if keep_months < 1:
+        # the current month would be rolled up, losing today's usage and daily budgets
+        raise ValueError(f"keep_months must be at least 1, got {keep_months}")
+    loop = asyncio.get_running_loop()
+    cutoff = cutoff_month(keep_months, today)
+    reports = []
+    for user_id in await loop.run_in_executor(None, store.user_ids):
+        loaded, load_before = await loop.run_in_executor(None, timed_load, store, user_id)
+        entries_before = loaded.history_entries()
+        bytes_before = len(json.dumps(loaded.usage))
+        if isinstance(store, SQLiteUsageStore):
+            # rolled up in SQL; live trackers pick the buckets up on their next refresh
+            await loop.run_in_executor(None, store.compact_history, user_id, cutoff)
+        else:
+            # the user may have become active while the file was read
+            tracker = resident_tracker(trackers, user_id) or loaded
+            with tracker.lock:
+                removed = compact_history(tracker.usage, cutoff)
+            if not removed:
+                continue
+            tracker.store.save(tracker)
+        compacted, load_after = await loop.run_in_executor(None, timed_load, store, user_id)
+        if compacted.history_entries() == entries_before:
+            continue
+        reports.append({
+            'user_id': user_id,
+            'entries_before': entries_before,
+            'entries_after': compacted.history_entries(),
+            'bytes_before': bytes_before,
+            'bytes_after': len(json.dumps(compacted.usage)),
+            'load_ms_before': load_before * 1000,
+            'load_ms_after': load_after * 1000,
+        })
+    return reports
+
+
+def summarize(reports: list[dict]) -> str:
+    reclaimed = sum(report['bytes_before'] - report['bytes_after'] for report in reports)
+    saved_ms = sum(report['load_ms_before'] - report['load_ms_after'] for report in reports)
+    return f"compacted {len(reports)} users, reclaimed {reclaimed} bytes, load time -{saved_ms:.1f} ms"
+
+
+async def run_usage_compactor(trackers, keep_months: int, interval: float):
+    """
+    Background task compacting the usage history every `interval` seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            reports = await compact_usage(get_usage_store(), keep_months, trackers)
+            logging.info(f'Usage compaction: {summarize(reports)}')
+        except Exception as e:
+            logging.warning(f'Usage compaction failed: {e}')
+
+
+def months_argument(value: str) -> int:
+    months = int(value)
+    if months < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: the current month is always kept per day")
+    return months
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Roll old per-day usage history into monthly buckets.")
+    parser.add_argument("--keep-months", type=months_argument, default=6,
+                        help="months kept with per-day entries, the current month included")
+    parser.add_argument("--logs-dir", default="usage_logs", help="directory of the JSON usage logs")
+    args = parser.parse_args()
+
+    reports = asyncio.run(compact_usage(get_usage_store(args.logs_dir), args.keep_months))
+    flush_usage_stores()
+    for report in reports:
+        print(f"{report['user_id']}: {report['entries_before']} -> {report['entries_after']} entries, "
+              f"{report['bytes_before']} -> {report['bytes_after']} bytes, "
+              f"load {report['load_ms_before']:.2f} -> {report['load_ms_after']:.2f} ms")
+    print(summarize(reports))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+from usage_analytics import CATEGORIES, prices_from_env, unit_prices
+from usage_store import SQLiteUsageStore
+from usage_tracker import UsageTracker, USAGE_KINDS
+
+MIGRATIONS_SCHEMA = """
+create table if not exists usage_migrations (
+    user_id     text primary key,
+    source_size integer not null,
+    source_mtime real not null,
+    migrated_at text not null default current_timestamp
+);
+"""
+
+
+class SourceFile:
+    """
+    Read-only store handing one parsed usage file (and its event log) to UsageTracker,
+    which normalises legacy shapes and replays the events.
+    """
+
+    def __init__(self, usage: dict, events: list[dict]):
+        self.usage = usage
+        self.events = events
+
+    def load(self, user_id):
+        return self.usage, self.events
+
+    def append(self, tracker, event: dict):
+        pass
+
+    def refresh(self, tracker):
+        pass
+
+
+def source_stat(path: str) -> tuple[int, float]:
+    """
+    Size and modification time of a usage file together with its event log,
+    used to detect files changed since their migration.
+    """
+    size, mtime = os.path.getsize(path), os.path.getmtime(path)
+    log_path = path[:-len(".json")] + ".log"
+    if os.path.isfile(log_path):
+        size, mtime = size + os.path.getsize(log_path), max(mtime, os.path.getmtime(log_path))
+    return size, mtime
+
+
+def read_user(path: str, prices: dict) -> dict:
+    """
+    Parses and normalises one usage file. Runs in the worker processes.
+    :return: user_id, user_name, rows (user_id, day, kind, variant, amount, cost),
+             expected per-kind amounts and all-time cost, source size and mtime
+    """
+    user_id = os.path.basename(path)[:-len(".json")]
+    source_size, source_mtime = source_stat(path)
+    with open(path, "r") as file:
+        usage = json.load(file)
+    events = []
+    log_path = path[:-len(".json")] + ".log"
+    if os.path.isfile(log_path):
+        with open(log_path, "r") as file:
+            for line in file:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+    tracker = UsageTracker(user_id, None, store=SourceFile(usage, events))
+
+    category_prices = dict(zip(CATEGORIES, unit_prices(prices)))
+    history = tracker.usage["usage_history"]
+    rows = []
+    for kind in ("chat_tokens", "transcription_seconds", "vision_tokens"):
+        for day, amount in history[kind].items():
+            rows.append((user_id, day, kind, "", amount, amount * category_prices[kind]))
+    for day, images in history["number_images"].items():
+        for size, count in enumerate(images):
+            if count:
+                rows.append((user_id, day, "number_images", str(size), count,
+                             count * category_prices[f"number_images:{size}"]))
+    for model, model_history in history["tts_characters"].items():
+        for day, characters in model_history.items():
+            rows.append((user_id, day, "tts_characters", model, characters,
+                         characters * category_prices[f"tts_characters:{model}"]))
+
+    all_time_cost = tracker.initialize_all_time_cost(
+        prices['token_price'], ",".join(str(price) for price in prices['image_prices']),
+        prices['transcription_price'], prices['vision_token_price'],
+        ",".join(str(price) for price in prices['tts_prices'])
+    )
+    return {
+        'user_id': user_id,
+        'user_name': tracker.usage.get("user_name"),
+        'rows': rows,
+        'amounts': {kind: tracker.totals[kind]["all_time"] for kind in USAGE_KINDS},
+        'all_time_cost': all_time_cost,
+        'source_size': source_size,
+        'source_mtime': source_mtime,
+    }
+
+
+def pending_files(store: SQLiteUsageStore, source_dir: str) -> list[str]:
+    """
+    Usage files not migrated yet or changed since their migration.
+    """
+    with store.lock:
+        store.conn.executescript(MIGRATIONS_SCHEMA)
+        done = {row[0]: (row[1], row[2]) for row in
+                store.conn.execute("select user_id, source_size, source_mtime from usage_migrations")}
+    paths = []
+    for name in sorted(os.listdir(source_dir)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(source_dir, name)
+        if done.get(name[:-len(".json")]) != source_stat(path):
+            paths.append(path)
+    return paths
+
+
+def write_batch(store: SQLiteUsageStore, users: list[dict]):
+    """
+    Replaces the rows of a batch of users and marks them migrated in one transaction,
+    so an interrupted migration resumes after the last committed batch.
+    """
+    with store.lock, store.conn:
+        ids = [(user['user_id'],) for user in users]
+        store.conn.executemany("delete from usage where user_id = ?", ids)
+        store.conn.executemany(
+            "insert into usage_users (user_id, user_name) values (?, ?) "
+            "on conflict (user_id) do update set user_name = excluded.user_name",
+            [(user['user_id'], user['user_name']) for user in users]
+        )
+        store.conn.executemany(
+            "insert into usage (user_id, day, kind, variant, amount, cost) values (?, ?, ?, ?, ?, ?)",
+            [row for user in users for row in user['rows']]
+        )
+        store.conn.executemany(
+            "insert into usage_migrations (user_id, source_size, source_mtime) values (?, ?, ?) "
+            "on conflict (user_id) do update set source_size = excluded.source_size, "
+            "source_mtime = excluded.source_mtime, migrated_at = current_timestamp",
+            [(user['user_id'], user['source_size'], user['source_mtime']) for user in users]
+        )
+
+
+def verify(store: SQLiteUsageStore, expected: dict[str, dict], tolerance: float = 0.02) -> list[str]:
+    """
+    Compares the migrated rows with the source: amounts per kind must match exactly,
+    the cost must match initialize_all_time_cost up to its rounding.
+    :return: descriptions of mismatches
+    """
+    actual: dict[str, dict] = {}
+    with store.lock:
+        for user_id, kind, amount, cost in store.conn.execute(
+                "select user_id, kind, sum(amount), sum(cost) from usage group by user_id, kind"):
+            if user_id in expected:
+                totals = actual.setdefault(user_id, {'amounts': {}, 'cost': 0.0})
+                totals['amounts'][kind] = amount
+                totals['cost'] += cost
+    errors = []
+    for user_id, source in expected.items():
+        totals = actual.get(user_id, {'amounts': {}, 'cost': 0.0})
+        for kind, amount in source['amounts'].items():
+            if abs(totals['amounts'].get(kind, 0) - amount) > 1e-6:
+                errors.append(f"{user_id}: {kind} {totals['amounts'].get(kind, 0)} != {amount}")
+        if abs(totals['cost'] - source['all_time_cost']) > tolerance:
+            errors.append(f"{user_id}: cost {totals['cost']:.6f} != {source['all_time_cost']:.6f}")
+    return errors
+
+
+def migrate(source_dir: str, target: str, workers: int = None, batch_size: int = 500) -> dict:
+    """
+    Migrates usage_logs/*.json (and pending event logs) into the SQLite usage store.
+    """
+    store = SQLiteUsageStore(target, refresh_interval=0)
+    prices = prices_from_env()
+    paths = pending_files(store, source_dir)
+    started = time.perf_counter()
+    expected, batch = {}, []
+    migrated = rows = source_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for user in pool.map(read_user, paths, [prices] * len(paths), chunksize=64):
+            batch.append(user)
+            expected[user['user_id']] = {'amounts': user['amounts'], 'all_time_cost': user['all_time_cost']}
+            if len(batch) >= batch_size:
+                write_batch(store, batch)
+                migrated, rows = migrated + len(batch), rows + sum(len(user['rows']) for user in batch)
+                source_bytes += sum(user['source_size'] for user in batch)
+                batch = []
+                print(f"migrated {migrated}/{len(paths)} users, "
+                      f"{migrated / (time.perf_counter() - started):.0f} users/s")
+    if batch:
+        write_batch(store, batch)
+        migrated, rows = migrated + len(batch), rows + sum(len(user['rows']) for user in batch)
+        source_bytes += sum(user['source_size'] for user in batch)
+    elapsed = time.perf_counter() - started
+    errors = verify(store, expected)
+    return {
+        'users': migrated,
+        'rows': rows,
+        'bytes': source_bytes,
+        'seconds': elapsed,
+        'errors': errors,
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Migrate JSON usage logs into the SQLite usage store.")
+    parser.add_argument("--source", default="usage_logs", help="directory with <user_id>.json usage files")
+    parser.add_argument("--target", default=os.getenv("USAGE_SQLITE_PATH", "data/usage.db"),
+                        help="SQLite usage database")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes, defaults to the CPU count")
+    parser.add_argument("--batch-size", type=int, default=500, help="users per transaction")
+    args = parser.parse_args()
+
+    report = migrate(args.source, args.target, args.workers, args.batch_size)
+    seconds = max(report['seconds'], 1e-9)
+    print(f"migrated {report['users']} users, {report['rows']} rows in {report['seconds']:.2f} s: "
+          f"{report['users'] / seconds:.0f} users/s, {report['rows'] / seconds:.0f} rows/s, "
+          f"{report['bytes'] / seconds / 1e6:.1f} MB/s")
+    for error in report['errors']:
+        print(f"MISMATCH {error}")
+    if report['errors']:
+        raise SystemExit(1)
+    print("totals verified against initialize_all_time_cost")
+
+
+if __name__ == '__main__':
+    main()
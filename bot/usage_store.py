@@ -0,0 +1,609 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import date
+
+
+def write_file_atomic(path: str, text: str):
+    """
+    Writes text to a temporary file and renames it over `path`,
+    so a crash never leaves a half-written usage file behind.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as outfile:
+        outfile.write(text)
+    os.replace(tmp_path, path)
+
+
+class BackgroundWriter:
+    """
+    Single background thread executing file writes in submission order,
+    so usage persistence never blocks the asyncio event loop.
+    """
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.submitted = 0
+        self.completed = 0
+        self.done = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            seq, func, args = self.tasks.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.warning(f'Usage writer task failed: {e}')
+            finally:
+                with self.done:
+                    self.completed = seq
+                    self.done.notify_all()
+                self.tasks.task_done()
+
+    def submit(self, func, *args) -> int:
+        """
+        Queues func(*args) and returns its sequence number.
+        """
+        with self.done:
+            self.submitted += 1
+            seq = self.submitted
+            self.tasks.put((seq, func, args))
+        return seq
+
+    def wait(self, seq: int):
+        """
+        Blocks until the task with sequence number seq (and every task before it) has been executed.
+        """
+        with self.done:
+            self.done.wait_for(lambda: self.completed >= seq)
+
+    def drain(self):
+        """
+        Blocks until every submitted task has been executed.
+        """
+        self.tasks.join()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> BackgroundWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BackgroundWriter()
+    return _writer
+
+
+class JSONUsageStore:
+    """
+    One JSON file per user in logs_dir. Charges only mark the user dirty; the file
+    is rewritten (atomically, in the background writer thread) once per flush_window
+    seconds no matter how many charges arrived in between.
+    """
+
+    name = "json"
+
+    def __init__(self, logs_dir: str = "usage_logs", flush_window: float = 2.0):
+        """
+        :param flush_window: seconds during which writes of dirty users are coalesced
+        """
+        self.logs_dir = logs_dir
+        self.flush_window = flush_window
+        self.writer = get_writer()
+        self.dirty: dict = {}  # {user_id: tracker changed since its last write}
+        self.dirty_lock = threading.Lock()
+        self.timer = None
+        self.last_writes: dict = {}  # {user_id: sequence number of the last queued write}
+        self.writes = 0
+        self.coalesced = 0
+        pathlib.Path(logs_dir).mkdir(exist_ok=True)
+
+    def path(self, user_id) -> str:
+        return f"{self.logs_dir}/{user_id}.json"
+
+    def load(self, user_id) -> tuple[dict | None, list[dict]]:
+        """
+        Returns the stored usage dict of the user (or None) and the events to replay on top of it.
+        """
+        # a user reloaded after eviction may still have writes in the queue
+        if user_id in self.last_writes:
+            self.writer.wait(self.last_writes.pop(user_id))
+        path = self.path(user_id)
+        if not os.path.isfile(path):
+            return None, []
+        with open(path, "r") as file:
+            return json.load(file), []
+
+    def append(self, tracker, event: dict):
+        with self.dirty_lock:
+            if tracker.user_id in self.dirty:
+                self.coalesced += 1
+            self.dirty[tracker.user_id] = tracker
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_window, self.flush_dirty)
+                self.timer.start()
+
+    def refresh(self, tracker):
+        pass
+
+    def flush_dirty(self):
+        """
+        Queues a write of every dirty user.
+        """
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, {}
+            self.timer = None
+        for user_id, tracker in dirty.items():
+            self.last_writes[user_id] = self.writer.submit(self._write, tracker, self.path(user_id))
+
+    def _write(self, tracker, path: str):
+        with tracker.lock:
+            text = json.dumps(tracker.usage)
+        write_file_atomic(path, text)
+        self.writes += 1
+
+    def save(self, tracker):
+        """
+        Queues a write of the whole tracker at once, e.g. after its history was compacted.
+        """
+        with self.dirty_lock:
+            self.dirty.pop(tracker.user_id, None)
+        self.last_writes[tracker.user_id] = self.writer.submit(self._write, tracker, self.path(tracker.user_id))
+
+    def flush(self, tracker):
+        """
+        Queues the write of a dirty tracker at once, e.g. before it is evicted.
+        """
+        with self.dirty_lock:
+            dirty = self.dirty.pop(tracker.user_id, None)
+        if dirty is not None:
+            self.last_writes[tracker.user_id] = self.writer.submit(self._write, tracker, self.path(tracker.user_id))
+
+    def flush_all(self):
+        """
+        Writes every dirty user and waits for the writes to finish.
+        """
+        with self.dirty_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush_dirty()
+        self.writer.drain()
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.name,
+            'dirty': len(self.dirty),
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'queue': self.writer.tasks.qsize(),
+        }
+
+    def user_ids(self) -> list[str]:
+        """
+        Returns the IDs of all users with stored usage.
+        """
+        return [name[:-len(".json")] for name in os.listdir(self.logs_dir) if name.endswith(".json")]
+
+
+class EventLogUsageStore(JSONUsageStore):
+    """
+    Append-only usage log: every charge appends one small JSON line to <user_id>.log
+    in the background writer thread. The log is periodically compacted into the
+    <user_id>.json snapshot (same format as JSONUsageStore) and truncated.
+    Loading reads the snapshot and replays the log on top of it.
+    """
+
+    name = "eventlog"
+
+    def __init__(self, logs_dir: str = "usage_logs", compact_every: int = 500):
+        """
+        :param compact_every: number of logged events per user after which the log is compacted
+        """
+        super().__init__(logs_dir)
+        self.compact_every = compact_every
+        self.log_sizes: dict = {}  # {user_id: events in the log since last compaction}
+        self.trackers: dict = {}  # {user_id: tracker with uncompacted events}
+
+    def log_path(self, user_id) -> str:
+        return f"{self.logs_dir}/{user_id}.log"
+
+    def load(self, user_id) -> tuple[dict | None, list[dict]]:
+        usage, _ = super().load(user_id)
+        events = []
+        log_path = self.log_path(user_id)
+        if os.path.isfile(log_path):
+            with open(log_path, "r") as file:
+                for line in file:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # a partially written last line after a crash
+                        logging.warning(f'Skipping corrupt usage event in {log_path}')
+        self.log_sizes[user_id] = len(events)
+        return usage, events
+
+    def append(self, tracker, event: dict):
+        user_id = tracker.user_id
+        self.last_writes[user_id] = self.writer.submit(self._append_line, self.log_path(user_id), json.dumps(event))
+        self.trackers[user_id] = tracker
+        self.log_sizes[user_id] = self.log_sizes.get(user_id, 0) + 1
+        if self.log_sizes[user_id] >= self.compact_every:
+            self.compact(tracker)
+
+    def compact(self, tracker):
+        """
+        Writes the tracker state as the new snapshot and truncates its log.
+        The state is serialized here, so it covers exactly the events queued before it;
+        the write runs in the writer thread after them. Amortized over compact_every events.
+        """
+        user_id = tracker.user_id
+        self.log_sizes[user_id] = 0
+        self.trackers.pop(user_id, None)
+        with tracker.lock:
+            snapshot = json.dumps(tracker.usage)
+        self.last_writes[user_id] = self.writer.submit(self._compact, snapshot, self.path(user_id), self.log_path(user_id))
+
+    def save(self, tracker):
+        self.compact(tracker)
+
+    def flush(self, tracker):
+        """
+        Queues compaction of the tracker's log without waiting for it.
+        """
+        if tracker.user_id in self.trackers:
+            self.compact(tracker)
+
+    def flush_all(self):
+        for tracker in list(self.trackers.values()):
+            self.compact(tracker)
+        self.writer.drain()
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.name,
+            'dirty': len(self.trackers),
+            'logged_events': sum(self.log_sizes.values()),
+            'queue': self.writer.tasks.qsize(),
+        }
+
+    @staticmethod
+    def _append_line(path: str, line: str):
+        with open(path, "a") as outfile:
+            outfile.write(line + "\n")
+
+    @staticmethod
+    def _compact(snapshot: str, path: str, log_path: str):
+        write_file_atomic(path, snapshot)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+
+SQLITE_SCHEMA = """
+create table if not exists usage_users (
+    user_id   text primary key,
+    user_name text
+);
+create table if not exists usage (
+    user_id text not null,
+    day     text not null,
+    kind    text not null,
+    variant text not null default '',
+    amount  numeric not null default 0,
+    cost    real not null default 0,
+    primary key (user_id, day, kind, variant)
+);
+create index if not exists usage_day_kind on usage (day, kind);
+create table if not exists usage_writers (
+    writer_id text primary key,
+    seq       integer not null
+);
+"""
+
+
+class SQLiteUsageStore:
+    """
+    Usage of all users in one SQLite database (WAL mode) with one row per
+    (user_id, day, kind, variant) holding the amount and cost of that day.
+    Charges are upserted in the background writer thread over the writer connection
+    and committed in batches: after commit_batch writes or as soon as the writer runs
+    out of work. current_cost is derived from the rows on load.
+
+    Several bot processes can share the database: increments are applied by SQL
+    (amount = amount + excluded.amount), so no process overwrites another's charges,
+    writers wait for each other's locks up to busy_timeout seconds, and trackers
+    re-read their rows every refresh_interval seconds to see the other processes' charges.
+    A batch that fails is rolled back and kept: a busy database is retried a few times, any other
+    failure leaves the charges pending until the next commit, so they are never dropped.
+
+    Reads use a separate connection and never wait for the writer. Charges of this process
+    not committed yet are kept in memory and replayed on top of the rows: every transaction
+    also stores the sequence number of its last charge in usage_writers, read in the same
+    snapshot as the rows, so each charge is counted exactly once.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = "data/usage.db", commit_batch: int = 100,
+                 refresh_interval: float = 5.0, busy_timeout: float = 30.0, write_retries: int = 3):
+        """
+        :param commit_batch: maximum number of writes per transaction
+        :param refresh_interval: seconds after which a tracker is reloaded on read, 0 disables reloading
+        :param busy_timeout: seconds to wait for a lock held by another process
+        :param write_retries: retries of a commit that found the database busy or locked
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.commit_batch = commit_batch
+        self.refresh_interval = refresh_interval
+        self.writer = get_writer()
+        self.writer_id = uuid.uuid4().hex
+        # the writer connection, used by the writer thread and maintenance
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("pragma synchronous=normal")
+        self.conn.executescript(SQLITE_SCHEMA)
+        self.conn.commit()
+        # the read connection: WAL readers see the last commit without waiting for writers
+        self.read_lock = threading.Lock()
+        self.reads = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self.batch: list[tuple] = []  # [(seq, user_id, user_name, event)] not committed yet
+        self.pending: dict = {}  # {user_id: [(seq, event)] not committed yet}
+        self.pending_lock = threading.Lock()
+        self.seq = 0
+        self.known_users: set = set()
+        self.failed: list[tuple] = []  # batch kept after a failed commit, written first by the next one
+        self.write_retries = write_retries
+        self.retries = 0
+
+    def load(self, user_id) -> tuple[dict | None, list[dict]]:
+        """
+        Returns the committed usage of the user and this process's charges not committed yet.
+        """
+        user_id = str(user_id)
+        # taken before the rows: a charge committed in between is covered by the writer's seq
+        with self.pending_lock:
+            pending = list(self.pending.get(user_id, ()))
+        with self.read_lock:
+            self.reads.execute("begin")
+            try:
+                user = self.reads.execute("select user_name from usage_users where user_id = ?", (user_id,)).fetchone()
+                rows = self.reads.execute(
+                    "select day, kind, variant, amount, cost from usage where user_id = ?", (user_id,)
+                ).fetchall()
+                committed = self.reads.execute(
+                    "select seq from usage_writers where writer_id = ?", (self.writer_id,)
+                ).fetchone()
+            finally:
+                self.reads.execute("commit")
+        committed = committed[0] if committed is not None else 0
+        events = [event for seq, event in pending if seq > committed]
+        if user is None and not rows:
+            return None, events
+        self.known_users.add(user_id)
+        today = str(date.today())
+        month = today[:7]
+        history = {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {},
+                   "tts_characters": {}, "vision_tokens": {}}
+        cost_day = cost_month = cost_all_time = 0.0
+        for day, kind, variant, amount, cost in rows:
+            if kind == "number_images":
+                history[kind].setdefault(day, [0, 0, 0])[int(variant)] += amount
+            elif kind == "tts_characters":
+                history[kind].setdefault(variant, {})[day] = amount
+            else:
+                history[kind][day] = amount
+            cost_all_time += cost
+            if day.startswith(month):
+                cost_month += cost
+            if day == today:
+                cost_day += cost
+        usage = {
+            "user_name": user[0] if user is not None else None,
+            "current_cost": {"day": cost_day, "month": cost_month, "all_time": cost_all_time, "last_update": today},
+            "usage_history": history,
+        }
+        return usage, events
+
+    def append(self, tracker, event: dict):
+        user_id = str(tracker.user_id)
+        user_name = None
+        if user_id not in self.known_users:
+            self.known_users.add(user_id)
+            user_name = tracker.usage.get("user_name")
+        with self.pending_lock:
+            self.seq += 1
+            seq = self.seq
+            self.pending.setdefault(user_id, []).append((seq, event))
+        self.writer.submit(self._write, seq, user_id, user_name, event)
+
+    def refresh(self, tracker):
+        """
+        Reloads the tracker from the database once refresh_interval seconds have passed,
+        picking up charges written by other processes.
+        """
+        if not self.refresh_interval or time.monotonic() - tracker.loaded_at < self.refresh_interval:
+            return
+        # no charge of the tracker can slip in between reading and replacing its usage
+        with tracker.lock:
+            try:
+                usage, events = self.load(tracker.user_id)
+            except sqlite3.Error as e:
+                # the in-memory usage stays valid, try again after the next interval
+                logging.warning(f'Usage refresh of user {tracker.user_id} failed: {e}')
+                tracker.loaded_at = time.monotonic()
+                return
+            if usage is not None:
+                tracker.reload(usage, events)
+            else:
+                tracker.loaded_at = time.monotonic()
+
+    def _write(self, seq: int, user_id: str, user_name, event: dict):
+        self.batch.append((seq, user_id, user_name, event))
+        if len(self.batch) >= self.commit_batch or self.writer.tasks.empty():
+            self._commit()
+
+    def _commit(self):
+        """
+        Writes the batch in one transaction. Runs in the writer thread, shared by all stores,
+        so it never blocks for long: a busy or locked database is retried write_retries times,
+        then the charges are kept (still pending, still replayed on load) and written first
+        by the next commit. Charges stay in order, so the committed seq stays exact.
+        """
+        batch = self.failed + self.batch
+        if not batch:
+            return
+        try:
+            delay = 0.1
+            for attempt in range(self.write_retries + 1):
+                try:
+                    self._write_batch(batch)
+                    break
+                except sqlite3.OperationalError as e:
+                    message = str(e).lower()
+                    if attempt == self.write_retries or ("locked" not in message and "busy" not in message):
+                        raise
+                    self.retries += 1
+                    logging.warning(f'Usage write of {len(batch)} charges failed: {e}. Retrying in {delay:.1f} s')
+                    time.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+        except Exception as e:
+            logging.error(f'Usage write of {len(batch)} charges failed: {e}. Keeping them for the next commit')
+            self.failed = batch
+            return
+        finally:
+            self.batch = []
+        self.failed = []
+        committed = batch[-1][0]
+        with self.pending_lock:
+            for user_id in {user_id for _, user_id, _, _ in batch}:
+                events = [item for item in self.pending.get(user_id, ()) if item[0] > committed]
+                if events:
+                    self.pending[user_id] = events
+                else:
+                    self.pending.pop(user_id, None)
+
+    def _write_batch(self, batch: list[tuple]):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "insert into usage_users (user_id, user_name) values (?, ?) on conflict (user_id) do nothing",
+                [(user_id, user_name) for _, user_id, user_name, _ in batch if user_name is not None]
+            )
+            self.conn.executemany(
+                "insert into usage (user_id, day, kind, variant, amount, cost) values (?, ?, ?, ?, ?, ?) "
+                "on conflict (user_id, day, kind, variant) "
+                "do update set amount = amount + excluded.amount, cost = cost + excluded.cost",
+                [(user_id, event["day"], event["kind"], str(event.get("variant", "")),
+                  event["amount"], event["cost"]) for _, user_id, _, event in batch]
+            )
+            self.conn.execute(
+                "insert into usage_writers (writer_id, seq) values (?, ?) "
+                "on conflict (writer_id) do update set seq = excluded.seq",
+                (self.writer_id, batch[-1][0])
+            )
+
+    def compact_history(self, user_id, cutoff: str):
+        """
+        Rolls the user's per-day rows of months before cutoff ('YYYY-MM') into monthly rows
+        in one transaction, keeping amounts and costs exact. Blocks until it is done.
+        """
+        self.writer.wait(self.writer.submit(self._compact_history, str(user_id), cutoff))
+
+    def _compact_history(self, user_id: str, cutoff: str):
+        # charges queued before the compaction are rolled up with the rest
+        self._commit()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "insert into usage (user_id, day, kind, variant, amount, cost) "
+                "select user_id, substr(day, 1, 7), kind, variant, sum(amount), sum(cost) from usage "
+                "where user_id = ? and length(day) > 7 and day < ? "
+                "group by substr(day, 1, 7), kind, variant "
+                "on conflict (user_id, day, kind, variant) "
+                "do update set amount = amount + excluded.amount, cost = cost + excluded.cost",
+                (user_id, cutoff)
+            )
+            self.conn.execute("delete from usage where user_id = ? and length(day) > 7 and day < ?", (user_id, cutoff))
+
+    def flush(self, tracker):
+        pass
+
+    def flush_all(self):
+        self.writer.wait(self.writer.submit(self._commit))
+        self.writer.drain()
+        if self.failed:
+            logging.error(f'{len(self.failed)} usage charges could not be written to {self.path}')
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.name,
+            'uncommitted': sum(len(events) for events in self.pending.values()),
+            'retries': self.retries,
+            'failed': len(self.failed),
+            'queue': self.writer.tasks.qsize(),
+        }
+
+    def user_ids(self) -> list[str]:
+        with self.read_lock:
+            return [row[0] for row in self.reads.execute("select user_id from usage_users")]
+
+
+_stores: dict = {}
+_stores_lock = threading.Lock()
+
+
+def get_usage_store(logs_dir: str = "usage_logs"):
+    """
+    Returns the process-wide usage store for logs_dir.
+    The backend is selected by USAGE_BACKEND: "json" (default), "eventlog" or "sqlite".
+    The SQLite store keeps all users in one database at USAGE_SQLITE_PATH instead of logs_dir.
+    """
+    backend = os.getenv("USAGE_BACKEND", "json").lower()
+    with _stores_lock:
+        key = (backend, os.getenv("USAGE_SQLITE_PATH", "data/usage.db") if backend == "sqlite" else logs_dir)
+        if key not in _stores:
+            if backend == "sqlite":
+                _stores[key] = SQLiteUsageStore(key[1], int(os.getenv("USAGE_COMMIT_BATCH", "100")),
+                                                float(os.getenv("USAGE_REFRESH_INTERVAL", "5")))
+            elif backend == "eventlog":
+                _stores[key] = EventLogUsageStore(logs_dir, int(os.getenv("USAGE_COMPACT_EVERY", "500")))
+            else:
+                _stores[key] = JSONUsageStore(logs_dir, float(os.getenv("USAGE_FLUSH_WINDOW", "2")))
+        return _stores[key]
+
+
+def get_guest_usage_store(logs_dir: str = "usage_logs"):
+    """
+    Returns the store for the guest usage shards. With the JSON backend the shards get
+    their own store flushed every GUEST_FLUSH_WINDOW seconds; the event log and SQLite
+    backends append per charge anyway and are shared with regular users.
+    """
+    backend = os.getenv("USAGE_BACKEND", "json").lower()
+    if backend != "json":
+        return get_usage_store(logs_dir)
+    with _stores_lock:
+        key = ("json-guests", logs_dir)
+        if key not in _stores:
+            _stores[key] = JSONUsageStore(logs_dir, float(os.getenv("GUEST_FLUSH_WINDOW", "30")))
+        return _stores[key]
+
+
+def flush_usage_stores():
+    """
+    Persists everything buffered by the usage stores. Called on shutdown.
+    """
+    for store in list(_stores.values()):
+        store.flush_all()
@@ -0,0 +1,61 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+PROCESSES = 4
+REQUESTS = 500
+TOKENS = 100
+USER_ID = 42
+
+
+def hammer(backend: str, directory: str):
+    # каждый процесс получает своё хранилище, как отдельный воркер бота
+    os.environ["USAGE_BACKEND"] = backend
+    os.environ["USAGE_SQLITE_PATH"] = os.path.join(directory, "usage.db")
+    from usage_tracker import UsageTracker
+    from usage_store import flush_usage_stores
+
+    tracker = UsageTracker(USER_ID, "@stress", logs_dir=os.path.join(directory, "usage_logs"))
+    for _ in range(REQUESTS):
+        tracker.add_chat_tokens(TOKENS, 0.002)
+    flush_usage_stores()
+
+
+def run(backend: str) -> bool:
+    directory = tempfile.mkdtemp(prefix=f"usage-{backend}-")
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    workers = [context.Process(target=hammer, args=(backend, directory)) for _ in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    os.environ["USAGE_BACKEND"] = backend
+    os.environ["USAGE_SQLITE_PATH"] = os.path.join(directory, "usage.db")
+    from usage_store import get_usage_store
+    from usage_tracker import UsageTracker
+    logs_dir = os.path.join(directory, "usage_logs")
+    tracker = UsageTracker(USER_ID, "@stress", logs_dir=logs_dir, store=get_usage_store(logs_dir))
+
+    expected_tokens = PROCESSES * REQUESTS * TOKENS
+    expected_cost = round(PROCESSES * REQUESTS * TOKENS * 0.002 / 1000, 6)
+    _, tokens_month = tracker.get_current_token_usage()
+    cost_month = round(tracker.get_current_cost()["cost_month"], 6)
+    ok = tokens_month == expected_tokens and cost_month == expected_cost
+    print(f"{backend:>8}: {PROCESSES} процесса x {REQUESTS} запросов за {elapsed:.2f} с, "
+          f"токенов {tokens_month}/{expected_tokens}, стоимость {cost_month}/{expected_cost} "
+          f"-> {'OK' if ok else 'ПОТЕРИ'}")
+    return ok
+
+
+if __name__ == '__main__':
+    # Нагрузочная проверка: несколько процессов одновременно списывают расходы одного пользователя.
+    # SQLite-хранилище обязано сохранить все списания; JSON показан для сравнения — он теряет обновления.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sqlite_ok = run("sqlite")
+    run("json")
+    sys.exit(0 if sqlite_ok else 1)
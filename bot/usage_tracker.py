@@ -1,19 +1,26 @@
-import os.path
-import pathlib
-import json
+import itertools
+import threading
+import time
 from datetime import date
 
+from usage_store import get_usage_store, get_guest_usage_store
+
 
 def year_month(date_str):
     # extract string of year-month from date, eg: '2023-03'
     return str(date_str)[:7]
 
 
+USAGE_KINDS = ["chat_tokens", "transcription_seconds", "number_images", "tts_characters", "vision_tokens"]
+
+
 class UsageTracker:
     """
     UsageTracker class
     Enables tracking of daily/monthly usage per user.
     User files are stored as JSON in /usage_logs directory.
+    Every charge is recorded as an event and handed to the usage store (see usage_store.py),
+    which decides how it is persisted.
     JSON example:
     {
         "user_name": "@user_name",
@@ -40,35 +47,164 @@ class UsageTracker:
     }
     """
 
-    def __init__(self, user_id, user_name, logs_dir="usage_logs"):
+    # callables (user_id, cost) notified of every recorded charge, e.g. the budget ledger
+    charge_listeners = []
+    # callables (user_id) notified when the usage is reloaded from the store with other processes' charges
+    reload_listeners = []
+
+    def __init__(self, user_id, user_name, logs_dir="usage_logs", store=None):
         """
         Initializes UsageTracker for a user with current date.
-        Loads usage data from usage log file.
+        Loads usage data from the usage store.
         :param user_id: Telegram ID of the user
         :param user_name: Telegram user name
         :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        :param store: usage store, defaults to the store selected by USAGE_BACKEND
         """
         self.user_id = user_id
         self.logs_dir = logs_dir
         # path to usage file of given user
         self.user_file = f"{logs_dir}/{user_id}.json"
-
-        if os.path.isfile(self.user_file):
-            with open(self.user_file, "r") as file:
-                self.usage = json.load(file)
-            if 'vision_tokens' not in self.usage['usage_history']:
-                self.usage['usage_history']['vision_tokens'] = {}
-            if 'tts_characters' not in self.usage['usage_history']:
-                self.usage['usage_history']['tts_characters'] = {}
+        self.store = store if store is not None else get_usage_store(logs_dir)
+        # guards self.usage against the background writer serializing it
+        self.lock = threading.RLock()
+
+        usage, events = self.store.load(user_id)
+        self.loaded_at = time.monotonic()
+        if usage is not None:
+            self.usage = usage
+            self.normalize_usage()
         else:
-            # ensure directory exists
-            pathlib.Path(logs_dir).mkdir(exist_ok=True)
             # create new dictionary for this user
             self.usage = {
                 "user_name": user_name,
                 "current_cost": {"day": 0.0, "month": 0.0, "all_time": 0.0, "last_update": str(date.today())},
                 "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens":{}}
             }
+        self.build_totals()
+        # replay events logged after the stored snapshot
+        for event in events:
+            self.apply_event(event)
+
+    def normalize_usage(self):
+        """Adds usage kinds missing from files written by older versions.
+        """
+        if 'vision_tokens' not in self.usage['usage_history']:
+            self.usage['usage_history']['vision_tokens'] = {}
+        if 'tts_characters' not in self.usage['usage_history']:
+            self.usage['usage_history']['tts_characters'] = {}
+
+    def reload(self, usage, events=()):
+        """Replaces the usage with a fresh copy from the store, e.g. one that includes
+        charges of other processes.
+        :param usage: usage dict as returned by the store
+        :param events: events to replay on top of it, as returned by the store
+        """
+        with self.lock:
+            self.usage = usage
+            self.normalize_usage()
+            self.build_totals()
+            for event in events:
+                self.apply_event(event)
+            self.loaded_at = time.monotonic()
+        for listener in self.reload_listeners:
+            listener(self.user_id)
+
+    # running totals:
+
+    def build_totals(self):
+        """Computes per-month and all-time totals of every usage kind from the usage history.
+        Runs once on load; afterwards apply_event keeps them up to date, so reads are constant time.
+        """
+        history = self.usage["usage_history"]
+        # {kind: {"all_time": amount, "months": {"2023-03": amount}}}
+        self.totals = {kind: {"all_time": 0, "months": {}} for kind in USAGE_KINDS}
+        for kind in USAGE_KINDS:
+            if kind == "tts_characters":
+                for model_history in history[kind].values():
+                    for day, characters in model_history.items():
+                        self.add_to_totals(kind, day, characters)
+            elif kind == "number_images":
+                for day, images in history[kind].items():
+                    self.add_to_totals(kind, day, sum(images))
+            else:
+                for day, amount in history[kind].items():
+                    self.add_to_totals(kind, day, amount)
+
+    def add_to_totals(self, kind, day, amount):
+        totals = self.totals[kind]
+        month = year_month(day)
+        totals["all_time"] += amount
+        totals["months"][month] = totals["months"].get(month, 0) + amount
+
+    def history_entries(self):
+        """Number of per-day history entries held in memory, used to bound the tracker cache.
+        """
+        history = self.usage["usage_history"]
+        entries = 0
+        for kind, values in history.items():
+            if kind == "tts_characters":
+                entries += sum(len(model_history) for model_history in values.values())
+            else:
+                entries += len(values)
+        return entries
+
+    def get_usage(self, kind, today=None):
+        """Get amount of a usage kind for today, this month and all time.
+        :param kind: one of USAGE_KINDS
+        :param today: reference date, defaults to the current date
+        :return: usage of the day, the month and all time
+        """
+        self.store.refresh(self)
+        today = str(today or date.today())
+        history = self.usage["usage_history"][kind]
+        if kind == "tts_characters":
+            usage_day = sum(model_history.get(today, 0) for model_history in history.values())
+        elif kind == "number_images":
+            usage_day = sum(history.get(today, []))
+        else:
+            usage_day = history.get(today, 0)
+        totals = self.totals[kind]
+        return usage_day, totals["months"].get(year_month(today), 0), totals["all_time"]
+
+    # usage events:
+
+    def record(self, kind, amount, cost, variant=None):
+        """Records one charge: applies it to the usage and hands it to the store.
+        :param kind: usage_history key, e.g. "chat_tokens"
+        :param amount: tokens, seconds, images or characters used
+        :param cost: USD cost of the request
+        :param variant: image size index for "number_images", model for "tts_characters"
+        """
+        event = {"day": str(date.today()), "kind": kind, "amount": amount, "cost": cost}
+        if variant is not None:
+            event["variant"] = variant
+        # a store refresh must not reload the usage between applying and storing the charge
+        with self.lock:
+            self.apply_event(event)
+            self.store.append(self, event)
+        for listener in self.charge_listeners:
+            listener(self.user_id, cost)
+
+    def apply_event(self, event):
+        """Applies a usage event to current costs and usage history.
+        :param event: dict with day, kind, amount, cost and optionally variant
+        """
+        day = event["day"]
+        kind = event["kind"]
+        amount = event["amount"]
+        with self.lock:
+            self.add_current_costs(event["cost"], date.fromisoformat(day))
+            history = self.usage["usage_history"]
+            if kind == "number_images":
+                # create new entry for the date if needed
+                history[kind].setdefault(day, [0, 0, 0])[event["variant"]] += amount
+            elif kind == "tts_characters":
+                model_history = history[kind].setdefault(event["variant"], {})
+                model_history[day] = model_history.get(day, 0) + amount
+            else:
+                history[kind][day] = history[kind].get(day, 0) + amount
+            self.add_to_totals(kind, day, amount)
 
     # token usage functions:
 
@@ -77,37 +213,15 @@ class UsageTracker:
         :param tokens: total tokens used in last request
         :param tokens_price: price per 1000 tokens, defaults to 0.002
         """
-        today = date.today()
         token_cost = round(float(tokens) * tokens_price / 1000, 6)
-        self.add_current_costs(token_cost)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["chat_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.record("chat_tokens", tokens, token_cost)
 
     def get_current_token_usage(self):
         """Get token amounts used for today and this month
 
         :return: total number of tokens used per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, tokens in self.usage["usage_history"]["chat_tokens"].items():
-            if today.startswith(month):
-                usage_month += tokens
+        usage_day, usage_month, _ = self.get_usage("chat_tokens")
         return usage_day, usage_month
 
     # image usage functions:
@@ -122,40 +236,16 @@ class UsageTracker:
         sizes = ["256x256", "512x512", "1024x1024"]
         requested_size = sizes.index(image_size)
         image_cost = image_prices[requested_size]
-        today = date.today()
-        self.add_current_costs(image_cost)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            # add token usage to existing date
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
-            self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
-
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.record("number_images", 1, image_cost, requested_size)
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, images in self.usage["usage_history"]["number_images"].items():
-            if today.startswith(month):
-                usage_month += sum(images)
+        usage_day, usage_month, _ = self.get_usage("number_images")
         return usage_day, usage_month
 
-
     # vision usage functions
     def add_vision_tokens(self, tokens, vision_token_price=0.01):
         """
@@ -163,37 +253,15 @@ class UsageTracker:
         :param tokens: total tokens used in last request
         :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
         """
-        today = date.today()
         token_price = round(tokens * vision_token_price / 1000, 2)
-        self.add_current_costs(token_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["vision_tokens"][str(today)] += tokens
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.record("vision_tokens", tokens, token_price)
 
     def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
 
         :return: total amount of vision tokens per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            tokens_day = self.usage["usage_history"]["vision_tokens"][str(today)]
-        else:
-            tokens_day = 0
-        month = str(today)[:7]  # year-month as string
-        tokens_month = 0
-        for today, tokens in self.usage["usage_history"]["vision_tokens"].items():
-            if today.startswith(month):
-                tokens_month += tokens
+        tokens_day, tokens_month, _ = self.get_usage("vision_tokens")
         return tokens_day, tokens_month
 
     # tts usage functions:
@@ -201,52 +269,17 @@ class UsageTracker:
     def add_tts_request(self, text_length, tts_model, tts_prices):
         tts_models = ['tts-1', 'tts-1-hd']
         price = tts_prices[tts_models.index(tts_model)]
-        today = date.today()
         tts_price = round(text_length * price / 1000, 2)
-        self.add_current_costs(tts_price)
-
-        if 'tts_characters' not in self.usage['usage_history']:
-            self.usage['usage_history']['tts_characters'] = {}
-        
-        if tts_model not in self.usage['usage_history']['tts_characters']:
-            self.usage['usage_history']['tts_characters'][tts_model] = {}
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-            # add requested text length to existing date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] += text_length
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.record("tts_characters", text_length, tts_price, tts_model)
 
     def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
 
         :return: total amount of characters converted to speech per day and per month
         """
-
-        tts_models = ['tts-1', 'tts-1-hd']
-        today = date.today()
-        characters_day = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"] and \
-                str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-                characters_day += self.usage["usage_history"]["tts_characters"][tts_model][str(today)]
-
-        month = str(today)[:7]  # year-month as string
-        characters_month = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"]: 
-                for today, characters in self.usage["usage_history"]["tts_characters"][tts_model].items():
-                    if today.startswith(month):
-                        characters_month += characters
+        characters_day, characters_month, _ = self.get_usage("tts_characters")
         return int(characters_day), int(characters_month)
 
-
     # transcription usage functions:
 
     def add_transcription_seconds(self, seconds, minute_price=0.006):
@@ -254,38 +287,27 @@ class UsageTracker:
         :param seconds: total seconds used in last request
         :param minute_price: price per minute transcription, defaults to 0.006
         """
-        today = date.today()
         transcription_price = round(seconds * minute_price / 60, 2)
-        self.add_current_costs(transcription_price)
-
-        # update usage_history
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            # add requested seconds to existing date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] += seconds
-        else:
-            # create new entry for current date
-            self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
-
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.record("transcription_seconds", seconds, transcription_price)
 
-    def add_current_costs(self, request_cost):
+    def add_current_costs(self, request_cost, today=None):
         """
         Add current cost to all_time, day and month cost and update last_update date.
+        :param today: date of the request, defaults to the current date
         """
-        today = date.today()
+        today = today or date.today()
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
 
         # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        self.usage["current_cost"]["all_time"] = \
-            self.usage["current_cost"].get("all_time", self.initialize_all_time_cost()) + request_cost
+        if "all_time" not in self.usage["current_cost"]:
+            self.usage["current_cost"]["all_time"] = self.initialize_all_time_cost()
+        self.usage["current_cost"]["all_time"] += request_cost
         # add current cost, update new day
         if today == last_update:
             self.usage["current_cost"]["day"] += request_cost
             self.usage["current_cost"]["month"] += request_cost
         else:
-            if today.month == last_update.month:
+            if year_month(today) == year_month(last_update):
                 self.usage["current_cost"]["month"] += request_cost
             else:
                 self.usage["current_cost"]["month"] = request_cost
@@ -297,16 +319,7 @@ class UsageTracker:
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
-        else:
-            seconds_day = 0
-        month = str(today)[:7]  # year-month as string
-        seconds_month = 0
-        for today, seconds in self.usage["usage_history"]["transcription_seconds"].items():
-            if today.startswith(month):
-                seconds_month += seconds
+        seconds_day, seconds_month, _ = self.get_usage("transcription_seconds")
         minutes_day, seconds_day = divmod(seconds_day, 60)
         minutes_month, seconds_month = divmod(seconds_month, 60)
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
@@ -317,6 +330,7 @@ class UsageTracker:
 
         :return: cost of current day and month
         """
+        self.store.refresh(self)
         today = date.today()
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
         if today == last_update:
@@ -324,12 +338,14 @@ class UsageTracker:
             cost_month = self.usage["current_cost"]["month"]
         else:
             cost_day = 0.0
-            if today.month == last_update.month:
+            if year_month(today) == year_month(last_update):
                 cost_month = self.usage["current_cost"]["month"]
             else:
                 cost_month = 0.0
-        # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        cost_all_time = self.usage["current_cost"].get("all_time", self.initialize_all_time_cost())
+        # initialize all_time cost with calculation of total_cost if key doesn't exist
+        if "all_time" not in self.usage["current_cost"]:
+            self.usage["current_cost"]["all_time"] = self.initialize_all_time_cost()
+        cost_all_time = self.usage["current_cost"]["all_time"]
         return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
 
     def initialize_all_time_cost(self, tokens_price=0.002, image_prices="0.016,0.018,0.02", minute_price=0.006, vision_token_price=0.01, tts_prices='0.015,0.030'):
@@ -362,3 +378,76 @@ class UsageTracker:
 
         all_time_cost = token_cost + transcription_cost + image_cost + vision_cost + tts_cost
         return all_time_cost
+
+
+class GuestUsageTracker:
+    """
+    Usage of all guest users, striped over several UsageTracker shards.
+    Each charge goes to the next shard, so no single file is rewritten on every
+    guest request; reads merge the shards. Shard 0 keeps the legacy "guests" ID,
+    the others are stored as "guests_1", "guests_2", ... Shards are persisted by
+    the guest usage store with its own flush window (GUEST_FLUSH_WINDOW).
+    """
+
+    def __init__(self, user_name="guest users", shards=4, logs_dir="usage_logs"):
+        """
+        :param user_name: name stored in the shard files
+        :param shards: number of shards
+        :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+        """
+        self.user_id = "guests"
+        store = get_guest_usage_store(logs_dir)
+        self.shards = [
+            UsageTracker("guests" if shard == 0 else f"guests_{shard}", user_name, logs_dir, store)
+            for shard in range(max(1, shards))
+        ]
+        self.store = store
+        self.next_shard = itertools.cycle(self.shards)
+
+    def add_chat_tokens(self, tokens, tokens_price=0.002):
+        next(self.next_shard).add_chat_tokens(tokens, tokens_price)
+
+    def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
+        next(self.next_shard).add_image_request(image_size, image_prices)
+
+    def add_vision_tokens(self, tokens, vision_token_price=0.01):
+        next(self.next_shard).add_vision_tokens(tokens, vision_token_price)
+
+    def add_tts_request(self, text_length, tts_model, tts_prices):
+        next(self.next_shard).add_tts_request(text_length, tts_model, tts_prices)
+
+    def add_transcription_seconds(self, seconds, minute_price=0.006):
+        next(self.next_shard).add_transcription_seconds(seconds, minute_price)
+
+    def history_entries(self):
+        return sum(shard.history_entries() for shard in self.shards)
+
+    def get_usage(self, kind, today=None):
+        usages = [shard.get_usage(kind, today) for shard in self.shards]
+        return tuple(sum(values) for values in zip(*usages))
+
+    def get_current_token_usage(self):
+        usage_day, usage_month, _ = self.get_usage("chat_tokens")
+        return usage_day, usage_month
+
+    def get_current_image_count(self):
+        usage_day, usage_month, _ = self.get_usage("number_images")
+        return usage_day, usage_month
+
+    def get_current_vision_tokens(self):
+        tokens_day, tokens_month, _ = self.get_usage("vision_tokens")
+        return tokens_day, tokens_month
+
+    def get_current_tts_usage(self):
+        characters_day, characters_month, _ = self.get_usage("tts_characters")
+        return int(characters_day), int(characters_month)
+
+    def get_current_transcription_duration(self):
+        seconds_day, seconds_month, _ = self.get_usage("transcription_seconds")
+        minutes_day, seconds_day = divmod(seconds_day, 60)
+        minutes_month, seconds_month = divmod(seconds_month, 60)
+        return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
+
+    def get_current_cost(self):
+        costs = [shard.get_current_cost() for shard in self.shards]
+        return {key: sum(cost[key] for cost in costs) for key in costs[0]}
@@ -11,9 +11,10 @@ import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
-from supabase_client import SupabaseClient
+from supabase_client import get_async_supabase_client
 
-from usage_tracker import UsageTracker
+from usage_tracker import UsageTracker, GuestUsageTracker
+from budget_ledger import get_budget_ledger
 
 def message_text(message: Message) -> str:
     """
@@ -149,7 +150,11 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
-async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
+async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False, access_record=None) -> bool:
+    """
+    Checks if the user is allowed to use the bot.
+    :param access_record: access record already fetched for this update, if any
+    """
     if config['admin_user_ids'] == '*':
         return True
 
@@ -157,8 +162,9 @@ async def is_allowed(config, update: Update, context: CallbackContext, is_inline
     if is_admin(config, user_id):
         return True
 
-    db = SupabaseClient()
-    if db.is_user_approved(user_id):
+    if access_record is None:
+        access_record = await get_async_supabase_client().get_access_record(user_id)
+    if access_record['approved']:
         return True
 
     # Можно логировать отказ
@@ -185,41 +191,62 @@ def is_admin(config, user_id: int, log_no_admin=False) -> bool:
     return False
 
 
-def get_user_budget(user_id: int, config: dict) -> float:
-    db = SupabaseClient()
-    approved_users = [
-        int(uid)
-        for uid, record in db.get_users().items()
-        if record.get('status') == 'approved'
-    ]
+def parse_user_budgets(raw_budgets: str) -> dict[int, float]:
+    """
+    Parses the USER_BUDGETS value ("id:budget,id:budget" or "*") into a {user_id: budget} map.
+    Called once at startup, the result is stored in config['user_budget_map'].
+    """
+    user_budgets = {}
+    if raw_budgets == '*':
+        return user_budgets
 
+    for item in raw_budgets.split(','):
+        if ':' in item:
+            uid_str, value = item.split(':')
+            try:
+                user_budgets[int(uid_str)] = float(value)
+            except ValueError:
+                logging.warning(f"Некорректный формат user_budgets: {item}")
+    return user_budgets
 
-    raw_budgets = config.get('user_budgets', '*')
-    user_budgets = {}
 
-    if raw_budgets != '*':
-        for item in raw_budgets.split(','):
-            if ':' in item:
-                uid_str, value = item.split(':')
-                try:
-                    user_budgets[int(uid_str)] = float(value)
-                except ValueError:
-                    logging.warning(f"Некорректный формат user_budgets: {item}")
-
-    if user_id in approved_users:
-        return user_budgets.get(user_id, float('inf'))
+async def get_user_budget(user_id: int, config: dict) -> float:
+    """
+    Returns the budget of the user: the configured budget for approved users
+    (unlimited if none is set), the guest budget otherwise.
+    """
+    if 'user_budget_map' not in config:
+        config['user_budget_map'] = parse_user_budgets(config.get('user_budgets', '*'))
+
+    record = await get_async_supabase_client().get_access_record(user_id)
+    if record['approved']:
+        return config['user_budget_map'].get(user_id, float('inf'))
     else:
         return config.get('guest_budget', 100.0)
 
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+async def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
+    Served from the budget ledger when it holds a current value, computed in full otherwise.
     :param config: The bot configuration object
     :param usage: The usage tracker object
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: The remaining budget for the user as a float
     """
+    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
+    ledger = get_budget_ledger(config)
+    remaining = ledger.get(user_id)
+    if remaining is None:
+        remaining = await compute_remaining_budget(config, usage, update, is_inline=is_inline)
+        ledger.set(user_id, remaining)
+    return remaining
+
+
+async def compute_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+    """
+    Full calculation of the remaining budget from the user's budget and UsageTracker costs.
+    """
     # Mapping of budget period to cost period
     budget_cost_map = {
         "monthly": "cost_month",
@@ -233,7 +260,7 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
         usage[user_id] = UsageTracker(user_id, name)
 
     # Get budget for users
-    user_budget = get_user_budget(user_id, config)
+    user_budget = await get_user_budget(user_id, config)
     budget_period = config['budget_period']
     if user_budget is not None:
         cost = usage[user_id].get_current_cost()[budget_cost_map[budget_period]]
@@ -241,26 +268,22 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
 
     # Get budget for guests
     if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
+        usage['guests'] = GuestUsageTracker('all guest users in group chats', shards=config.get('guest_usage_shards', 4))
     cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
     return config['guest_budget'] - cost
 
 
-def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
+async def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
     """
     Checks if the user reached their usage limit.
-    Initializes UsageTracker for user and guest when needed.
+    Initializes UsageTracker for user and guest when the budget has to be computed.
     :param config: The bot configuration object
     :param usage: The usage tracker object
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: Boolean indicating if the user has a positive budget
     """
-    user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
-    name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
-    remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
+    remaining_budget = await get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
 
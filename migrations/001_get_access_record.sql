@@ -0,0 +1,32 @@
+-- 001: get_access_record
+--
+-- Возвращает статус доступа пользователя (approved / blocked / paid / username)
+-- одним запросом вместо трёх отдельных обращений к users и blocked_users.
+-- Вызывается из SupabaseClient.get_access_record через PostgREST RPC:
+--   supabase.rpc("get_access_record", {"p_user_id": 123}).execute()
+--
+-- users.id хранится как text (бот пишет str(user_id)), blocked_users.user_id — bigint.
+
+create or replace function get_access_record(p_user_id bigint)
+returns table (
+    user_id  bigint,
+    approved boolean,
+    blocked  boolean,
+    paid     boolean,
+    username text
+)
+language sql
+stable
+as $$
+    select
+        p_user_id,
+        coalesce(u.status = 'approved', false) and not b.flag,
+        b.flag,
+        coalesce(u.paid, false),
+        u.username
+    from (select exists(select 1 from blocked_users where blocked_users.user_id = p_user_id) as flag) as b
+    left join users u on u.id = p_user_id::text
+    limit 1;
+$$;
+
+create index if not exists blocked_users_user_id_idx on blocked_users (user_id);
@@ -0,0 +1,73 @@
+-- 002: transactional approve / reject / block
+--
+-- Каждое действие администратора выполняется одной серверной функцией,
+-- то есть одним запросом и одной транзакцией: частичный сбой больше не
+-- оставляет пользователя одновременно в join_requests и users.
+-- Вызываются из SupabaseClient.approve_user / reject_user / block_user /
+-- approve_all_pending через PostgREST RPC.
+--
+-- Требуется уникальность users.id и blocked_users.user_id.
+
+create or replace function approve_user(p_user_id bigint, p_username text default null)
+returns void
+language sql
+as $$
+    with unblocked as (
+        delete from blocked_users where user_id = p_user_id
+    ),
+    pending as (
+        delete from join_requests where user_id = p_user_id returning username
+    )
+    insert into users (id, username, status)
+    values (
+        p_user_id::text,
+        coalesce(p_username, (select username from pending limit 1)),
+        'approved'
+    )
+    on conflict (id) do update set username = excluded.username, status = 'approved';
+$$;
+
+create or replace function reject_user(p_user_id bigint)
+returns void
+language sql
+as $$
+    with pending as (
+        delete from join_requests where user_id = p_user_id returning username
+    )
+    insert into blocked_users (user_id, username)
+    values (p_user_id, (select username from pending limit 1))
+    on conflict (user_id) do nothing;
+$$;
+
+create or replace function block_user(p_user_id bigint)
+returns void
+language sql
+as $$
+    with removed as (
+        delete from users where id = p_user_id::text returning username
+    )
+    insert into blocked_users (user_id, username)
+    values (p_user_id, coalesce((select username from removed limit 1), ''))
+    on conflict (user_id) do update set username = excluded.username;
+$$;
+
+-- Одобряет все заявки одним запросом и возвращает одобренных пользователей,
+-- чтобы бот мог их уведомить.
+create or replace function approve_all_pending()
+returns table (user_id bigint, username text)
+language sql
+as $$
+    with pending as (
+        delete from join_requests returning join_requests.user_id, join_requests.username
+    ),
+    unblocked as (
+        delete from blocked_users b using pending p where b.user_id = p.user_id
+    ),
+    approved as (
+        insert into users (id, username, status)
+        select distinct on (p.user_id) p.user_id::text, p.username, 'approved'
+        from pending p
+        on conflict (id) do update set username = excluded.username, status = 'approved'
+    )
+    select distinct on (p.user_id) p.user_id, p.username from pending p;
+$$;
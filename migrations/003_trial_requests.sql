@@ -0,0 +1,22 @@
+-- 003: trial_requests
+--
+-- Счётчики бесплатных (пробных) запросов неоплативших пользователей.
+-- Раньше они жили в памяти процесса и обнулялись при каждом перезапуске.
+-- Бот копит приращения локально и периодически сбрасывает их одним вызовом
+-- increment_trial_requests; сложение выполняется на сервере, поэтому
+-- несколько процессов бота не перезаписывают значения друг друга.
+
+create table if not exists trial_requests (
+    user_id bigint primary key,
+    used    integer not null default 0
+);
+
+-- p_deltas: {"<user_id>": <приращение>, ...}
+create or replace function increment_trial_requests(p_deltas jsonb)
+returns void
+language sql
+as $$
+    insert into trial_requests (user_id, used)
+    select key::bigint, value::integer from jsonb_each_text(p_deltas)
+    on conflict (user_id) do update set used = trial_requests.used + excluded.used;
+$$;
@@ -0,0 +1,6 @@
+-- 004: индекс для точечного поиска заявки пользователя
+--
+-- SupabaseClient.get_request / has_pending_request ищут заявку по user_id
+-- вместо загрузки всей таблицы join_requests.
+
+create index if not exists join_requests_user_id_idx on join_requests (user_id);